@@ -17,11 +17,12 @@ setup(name='SpikeSort',
                 'spike_analysis',
                 ],
       package_dir = {"": "src"},
+      python_requires='>=3.8',
       install_requires=[
           'matplotlib',
           'tables',
-          'numpy >= 1.4.1',
-          'scipy'
+          'numpy >= 1.17',
+          'scipy >= 1.3'
         ]
       
      )
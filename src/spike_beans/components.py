@@ -13,6 +13,7 @@ from spike_sort.ui import plotting
 from spike_sort.ui import zoomer
 from spike_analysis import dashboard
 import numpy as np
+import warnings
 
 class GenericSource(base.Component):
     
@@ -208,25 +209,70 @@ class SpikeExtractor(base.Component):
     spikes = property(read_spikes)
     
 class FeatureExtractor(base.Component):
+    """Calculate features of spike waveforms
+    
+    `normalize` can be either a bool or a fitted (or not yet fitted)
+    :py:class:`spike_sort.core.features.Normalizer`. In the latter case
+    the same normalization is applied to the features of all updates.
+    If `normalize` is True, a new normalizer is fitted on each update.
+    The normalizer of the current features is available as the
+    `normalizer` attribute (None without normalization).
+    """
     spikes_src = base.RequiredFeature("SpikeSource", 
                                       base.HasAttributes("spikes"))
     
-    def __init__(self, normalize=True):
-        self.feature_methods = []
+    def __init__(self, normalize=True, n_jobs=1, backend='threads'):
+        self._feature_specs = []
         self._feature_data = None
         self.normalize = normalize
+        self.normalizer = None
+        self.n_jobs = n_jobs
+        self.backend = backend
         super(FeatureExtractor, self).__init__()
         
     def add_feature(self, name, *args, **kwargs):
         func_name = "fet" + name
-        _func = features.__getattribute__(func_name)
-        func = lambda x: _func(x, *args, **kwargs)
-        self.feature_methods.append(func)
+        #fail early for unknown features
+        features.__getattribute__(func_name)
+        self._feature_specs.append((func_name, args, kwargs))
+    
+    @property
+    def feature_specs(self):
+        """List of (function_name, args, kwargs) triples of the added
+        features (see :py:func:`spike_sort.core.features.calc_features`)"""
+        return list(self._feature_specs)
+    
+    @property
+    def feature_methods(self):
+        """Feature functions (taking spike waveforms) of the added 
+        features"""
+        def _bind(func_name, args, kwargs):
+            _func = features.__getattribute__(func_name)
+            return lambda x: _func(x, *args, **kwargs)
+        return [_bind(*spec) for spec in self._feature_specs]
     
     def _calc_features(self):
         spikes = self.spikes_src.spikes
-        feats = [f(spikes) for f in self.feature_methods]
-        self._feature_data = features.combine(feats, norm=self.normalize)
+        feats = features.calc_features(spikes, self._feature_specs,
+                                       n_jobs=self.n_jobs,
+                                       backend=self.backend)
+        feature_data = features.combine(feats, norm=False, 
+                                        dtype=np.float32)
+        if isinstance(self.normalize, features.Normalizer):
+            self.normalizer = self.normalize
+            if not self.normalizer.is_fitted:
+                self.normalizer.fit(feature_data)
+        elif self.normalize:
+            #fit on all spikes, as features.normalize does
+            self.normalizer = features.Normalizer().fit(
+                                    {'data': feature_data['data'],
+                                     'names': feature_data['names']})
+        else:
+            self.normalizer = None
+        if self.normalizer is not None:
+            feature_data = self.normalizer.transform(feature_data, 
+                                                     copy=False)
+        self._feature_data = feature_data
     
     def read_features(self):
         if self._feature_data is None:
@@ -240,6 +286,18 @@ class FeatureExtractor(base.Component):
     features = property(read_features)
         
 class ClusterAnalyzer(base.Component):
+    """Cluster spikes and manage the cell labels
+    
+    With `warm_start` set to True, updates of features recluster the
+    spikes starting from the current labels (see
+    :py:func:`spike_sort.core.cluster.cluster_warm`), so that the 
+    labels of cells and the deleted spikes are preserved.
+    
+    The `stats` attribute gives the feature statistics of all cells
+    (:py:class:`spike_sort.core.cluster.ClusterStats`), which are
+    updated incrementally when cells are edited. Set `stats_covariance`
+    to True to keep also their covariances.
+    """
     feature_src = base.RequiredFeature("FeatureSource", 
                                        base.HasAttributes("features"))
     
@@ -251,53 +309,89 @@ class ClusterAnalyzer(base.Component):
         self.trash_label = 0
         super(ClusterAnalyzer, self).__init__()
         self.use_features='all'
+        self.fit_size = None
+        self.warm_start = False
+        self.stats_covariance = False
+        self._stats = None
     
-    def _cluster(self, idx, method, *args,**kwargs):
+    def _get_features(self):
         feature_data = self.feature_src.features
         use_features = self.use_features
         
         if use_features != 'all' and use_features is not None:
-            names = list(feature_data['names'])
             try:
-                ii = np.array([names.index(l) for l in use_features])
-                feature_data  = feature_data.copy()
-                feature_data['data'] = feature_data['data'][:,ii]
-                feature_data['names'] = feature_data['names'][ii]
-            except ValueError:
-                raise ValueError("Feature {0} does not exist" % l)
+                feature_data = sort.features.select(feature_data, 
+                                                    use_features)
+            except KeyError as e:
+                raise ValueError(e.args[0])
+        return feature_data
+    
+    def _cluster_features(self, method, features, *args, **kwargs):
+        if self.fit_size:
+            return sort.cluster.cluster_subsample(method, features,
+                                                  self.fit_size, *args,
+                                                  **kwargs)
+        return sort.cluster.cluster(method, features, *args, **kwargs)
+    
+    def _cluster(self, idx, method, *args,**kwargs):
+        feature_data = self._get_features()
             
         if idx is not None:
             new_features = sort.features.select_spikes(feature_data, idx)
-            clust_idx = sort.cluster.cluster(method, new_features, *args, 
-                                         **kwargs)
-            all_labels = set(range(1, 100))
-            used_labels = set(np.unique(self.cluster_labels))
-            free_labels = list(all_labels - used_labels)
-            free_labels.sort(reverse=True)
-            new_clust_idx = np.zeros(len(clust_idx), dtype="int16")
-            for l in np.unique(clust_idx):
-                new_label = free_labels.pop()
-                new_clust_idx[clust_idx==l]= new_label
+            clust_idx = self._cluster_features(method, new_features, *args,
+                                               **kwargs)
+            allocator = sort.cluster.LabelAllocator.from_labels(
+                                                        self.cluster_labels)
+            allocator.used.add(self.trash_label)
+            new_clust_idx = np.empty(len(clust_idx), 
+                                     dtype=self.cluster_labels.dtype)
+            new_clust_idx[:] = self.trash_label
+            #negative labels mark noise (or invalid spikes)
+            clustered = clust_idx >= 0
+            label_ids, inv = np.unique(clust_idx[clustered], 
+                                       return_inverse=True)
+            new_labels = np.array(allocator.allocate(len(label_ids)), 
+                                  dtype=new_clust_idx.dtype)
+            new_clust_idx[clustered] = new_labels[inv]
                 
+            if self._stats is not None:
+                self._stats.move(feature_data['data'][idx], 
+                                 self.cluster_labels[idx], new_clust_idx)
             self.cluster_labels[idx] = new_clust_idx
         else:
-            clust_idx = sort.cluster.cluster(method,feature_data, *self.args, 
-                                         **kwargs)
+            clust_idx = self._cluster_features(method, feature_data, 
+                                               *self.args, **kwargs)
             self.cluster_labels = clust_idx+1
+            self._stats = None
             
     
+    def read_stats(self):
+        if self._stats is None:
+            self._stats = sort.cluster.ClusterStats.from_labels(
+                                self._get_features()['data'], self.labels,
+                                covariance=self.stats_covariance)
+        return self._stats
+    
+    stats = property(read_stats)
+    
     def read_labels(self):
         if self.cluster_labels is None:
             self._cluster(None, self.method, *self.args, **self.kwargs)
         return self.cluster_labels
     
+    def _remap(self, mapping):
+        self.cluster_labels[:] = sort.cluster.remap_labels(
+                                            self.cluster_labels, mapping)
+    
     def relabel(self):
         """rename cells in sequential order"""
-        labels = list(np.unique(self.labels))
+        labels = list(sort.cluster._unique_labels(self.labels))
         if self.trash_label in labels:
             labels.remove(self.trash_label)
-        for i, l in enumerate(labels):
-            self.cluster_labels[self.cluster_labels==l] = i+1
+        mapping = dict([(l, i+1) for i, l in enumerate(labels) if l != i+1])
+        self._remap(mapping)
+        if self._stats is not None:
+            self._stats.rename(mapping)
         self.notify_observers()
     
     def recluster(self, label, method=None, *args, **kwargs):
@@ -315,9 +409,11 @@ class ClusterAnalyzer(base.Component):
         """move selected labels to thrash (cluster 0). 
         if 'all' thrash all cells """
         if len(cell_ids)==1 and cell_ids[0]=='all':
-            cell_id = np.unique(self.labels)
-        for cell_id in cell_ids:
-            self.cluster_labels[self.cluster_labels==cell_id] = self.trash_label
+            cell_ids = np.unique(self.labels)
+        self._remap(dict([(cell_id, self.trash_label) 
+                          for cell_id in cell_ids]))
+        if self._stats is not None:
+            self._stats.merge(cell_ids, self.trash_label)
         self.notify_observers()
         
     def delete_spikes(self, idx_list):
@@ -329,18 +425,74 @@ class ClusterAnalyzer(base.Component):
             list of spike indices to remove
             
         """
+        if self._stats is not None:
+            idx = np.unique(idx_list)
+            self._stats.move(self._get_features()['data'][idx], 
+                             self.cluster_labels[idx], self.trash_label)
         self.cluster_labels[idx_list] = self.trash_label
         self.notify_observers()
     
     def merge_cells(self, *cell_ids):
         """merge selected cells. after merging all cells receive the label of the
         first cell"""
-        for cell in cell_ids:
-            self.cluster_labels[self.cluster_labels==cell]=cell_ids[0]
+        self._remap(dict([(cell, cell_ids[0]) for cell in cell_ids]))
+        if self._stats is not None:
+            self._stats.merge(cell_ids[1:], cell_ids[0])
         self.notify_observers()
         
+    def export_model(self, covariance=True, alpha=1e-3, 
+                     with_features=True):
+        """Create a :py:class:`spike_sort.core.cluster.ClusterModel` of
+        the sorted cells, which can be used to assign spikes of other
+        recordings
+        
+        The model includes feature definitions (`feature_specs`) and the
+        fitted normalization of the feature source (see
+        :py:class:`FeatureExtractor`), so that features of new spikes
+        are mapped to the space of the current clusters. If the feature
+        source does not define its features, a ValueError is raised
+        unless `with_features` is False; such a model can only assign
+        spikes from already calculated features.
+        """
+        feature_data = self._get_features()
+        normalizer = getattr(self.feature_src, 'normalizer', None)
+        if normalizer is None and getattr(self.feature_src, 'normalize', 
+                                          False) is True:
+            warnings.warn("feature source does not provide its fitted "
+                          "normalizer; features of new spikes will not be "
+                          "normalized by the model")
+        feature_specs = None
+        if with_features:
+            feature_specs = getattr(self.feature_src, 'feature_specs', None)
+            if not feature_specs:
+                raise ValueError("feature source does not define its "
+                                 "features (feature_specs); use "
+                                 "with_features=False to export the "
+                                 "model without them")
+        return sort.cluster.ClusterModel.from_labels(
+                            feature_data, self.labels, self.trash_label, 
+                            covariance=covariance, alpha=alpha, 
+                            normalizer=normalizer,
+                            feature_specs=feature_specs)
+        
+    def _warm_cluster(self):
+        feature_data = self._get_features()
+        labels = np.asarray(self.cluster_labels, dtype=int)
+        labels[labels==self.trash_label] = -1
+        # the first argument (number of clusters) is given by the labels
+        new_labels = sort.cluster.cluster_warm(self.method, feature_data,
+                                               labels, *self.args[1:], 
+                                               **self.kwargs)
+        new_labels[new_labels<0] = self.trash_label
+        self.cluster_labels = new_labels
+        
     def _update(self):
-        self._cluster(None, self.method, *self.args, **self.kwargs)
+        self._stats = None
+        if (self.warm_start and self.cluster_labels is not None and
+            len(self.cluster_labels) == len(self.feature_src.features['data'])):
+            self._warm_cluster()
+        else:
+            self._cluster(None, self.method, *self.args, **self.kwargs)
         
     labels = property(read_labels)
 
@@ -519,12 +671,25 @@ class PlotFeaturesTimeline(PlotFeatures):
     spk_time_src =  base.RequiredFeature("SpikeMarkerSource", 
                                          base.HasAttributes("events"))
     
+    def __init__(self):
+        super(PlotFeaturesTimeline, self).__init__()
+        self._feature_matrix = None
+    
     def _get_features(self):
+        """Return the features with spike times for plotting
+        
+        The returned structure shares memory with a matrix which is 
+        reused by the next redraw, so it is valid only until then (copy
+        it to keep the data)."""
         spt_dict = self.spk_time_src.events
         feats = self.feature_src.features
         spk_time = sort.features.fetSpTime(spt_dict)
-        new_features = sort.features.combine((spk_time,feats), norm=True)
-        return new_features
+        #reuse the matrix allocated for the previous redraw
+        matrix = sort.features.build_matrix((spk_time, feats),
+                                            out=self._feature_matrix)
+        matrix.normalize()
+        self._feature_matrix = matrix
+        return matrix.to_dict()
                
 class PlotSpikes(MplPlotComponent):
     spike_src = base.RequiredFeature("SpikeSource", base.HasAttributes("spikes"))
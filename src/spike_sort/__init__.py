@@ -3,6 +3,12 @@
 
 from spike_sort.core import *
 
-from spike_sort.ui import plotting
 from . import io
 
+def __getattr__(name):
+    #import matplotlib only when plotting is actually used
+    if name == 'plotting':
+        from spike_sort.ui import plotting
+        return plotting
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
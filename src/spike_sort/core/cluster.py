@@ -2,33 +2,148 @@
 #coding=utf-8
 
 import numpy as np
+import importlib
+import json
+import copy
+from concurrent import futures
+from scipy import special, spatial, sparse
+from scipy.sparse import csgraph
+from . import features as _features
 
-def default_scikits(method):
-    def foo(*args):
+######################################################################
+## 
+## Registry of clustering methods
+##  
+######################################################################
+
+_methods = {}
+_models = {}
+
+def _import_object(path):
+    """Import object given by 'module:name' or 'module.name' path"""
+    if ':' in path:
+        module_name, obj_name = path.split(':')
+    else:
+        module_name, obj_name = path.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, obj_name)
+
+def register_method(name, func, model=None):
+    """Register a clustering method that can be used with 
+    :py:func:`cluster`.
+    
+    Parameters
+    ----------
+    name : str
+        name of the method
+    func : callable or str
+        function taking the (n_spikes, n_features) data array (and
+        optional arguments) and returning cluster labels; it can be also
+        given as a 'module:function' string, in which case the module is
+        imported only when the method is first used
+    model : callable or str, optional
+        factory taking the same optional arguments as `func` and
+        returning an object with `fit(data)` and `predict(data)`
+        methods; it is used by :py:func:`cluster_subsample` to assign
+        spikes that were not used for fitting
+    """
+    _methods[name] = func
+    if model is None:
+        _models.pop(name, None)
+    else:
+        _models[name] = model
+
+def get_method(name):
+    """Return the clustering function registered under `name`"""
+    try:
+        func = _methods[name]
+    except KeyError:
         raise NotImplementedError(
-                    "scikits.learn must be installed to use %s" % method
+                    "clustering method %s is not implemented" % name
                     )
-    return foo
+    if isinstance(func, str):
+        func = _import_object(func)
+        _methods[name] = func
+    return func
+
+def get_model(name):
+    """Return the model factory registered with method `name` or None
+    if the method does not define one"""
+    model = _models.get(name)
+    if isinstance(model, str):
+        model = _import_object(model)
+        _models[name] = model
+    return model
+
+def list_methods():
+    """Return names of all registered clustering methods"""
+    return sorted(_methods)
 
-try:
-    from scikits.learn import cluster as skcluster
-    from scikits.learn import mixture
+class SklearnMethod(object):
+    """Adapter turning a scikit-learn estimator to a clustering method.
     
-    def k_means_plus(*args, **kwargs):
-        """k means with smart initialization.
+    The estimator is imported on the first call.
+    
+    Parameters
+    ----------
+    estimator : str or class
+        estimator class or its path (for example,
+        'sklearn.cluster.KMeans')
+    k_param : str or None
+        name of the estimator parameter setting the number of clusters
+        (passed as the first positional argument to the method)
+    defaults : 
+        default parameters of the estimator
+        
+    Examples
+    --------
+    >>> from spike_sort.core import cluster
+    >>> cluster.register_method('birch', 
+    ...                         cluster.SklearnMethod('sklearn.cluster.Birch'))
+    """
+    
+    def __init__(self, estimator, k_param='n_clusters', **defaults):
+        self.estimator = estimator
+        self.k_param = k_param
+        self.defaults = defaults
+        
+    def _get_estimator(self):
+        if isinstance(self.estimator, str):
+            try:
+                self.estimator = _import_object(self.estimator)
+            except ImportError:
+                raise NotImplementedError(
+                    "scikit-learn must be installed to use %s" % 
+                    self.estimator)
+        return self.estimator
+    
+    def __call__(self, data, k=None, **kwargs):
+        estimator_cls = self._get_estimator()
+        params = dict(self.defaults)
+        params.update(kwargs)
+        if k is not None:
+            params[self.k_param] = k
+        estimator = estimator_cls(**params)
+        if hasattr(estimator, 'fit_predict'):
+            return estimator.fit_predict(data)
+        return estimator.fit(data).predict(data)
+
+k_means_plus = SklearnMethod('sklearn.cluster.KMeans', init='k-means++',
+                             n_init=10)
+k_means_plus.__doc__ = """k means with smart initialization.
        
         Notes
         -----
-        This function requires scikits-learn
+        This function requires scikit-learn
         
         See Also
         --------
         kmeans
         """
-        return skcluster.k_means(*args, **kwargs)[1]
-    
-    def gmm(data, k):
-        """Cluster based on gaussian mixture models 
+        
+sk_gmm = SklearnMethod('sklearn.mixture.GaussianMixture', 'n_components',
+                       covariance_type='full')
+sk_gmm.__doc__ = """Cluster based on gaussian mixture models (scikit-learn)
         
         Parameters
         ----------
@@ -44,24 +159,37 @@ try:
        
         Notes
         -----
-        This function requires scikits-learn
-         
+        This function requires scikit-learn
+
+        See Also
+        --------
+        gmm
         """
-        try:
-            clf = mixture.GMM(n_states=k, cvtype='full')
-        except TypeError:
-            clf = mixture.GMM(n_components=k, cvtype='full')
-        clf.fit(data)
-        cl = clf.predict(data)
-        return cl
 
-    
-except ImportError:
-    k_means_plus = default_scikits("k_means_plus")
-    gmm = default_scikits("gmm")
+def gmm(data, k, **kwargs):
+    """Cluster based on gaussian mixture models 
+        
+    Parameters
+    ----------
+    data : dict
+        features structure
+    k :  int
+        number of clusters
+    kwargs :
+        arguments passed to :py:class:`spike_sort.core.mixture.GMM`
+        (`cov_type`, `tol`, `max_iter`, `dtype`, `seed`, `init`,
+        `n_init`, `n_jobs`)
 
+    Returns
+    -------
+    cl : int array
+        cluster indicies
+    """
+    return _gmm_model(k, **kwargs).fit(data).predict(data)
 
-from spike_sort.ui import manual_sort
+def _gmm_model(k, **kwargs):
+    from spike_sort.core import mixture
+    return mixture.GMM(k, **kwargs)
 
 def manual(data, *args, **kwargs):
     """Sort spikes manually by cluster cutting
@@ -73,7 +201,7 @@ def manual(data, *args, **kwargs):
     -----
     Only two first features are plotted
     """
-
+    from spike_sort.ui import manual_sort
 
     return manual_sort._cluster(data[:,:2])
 
@@ -81,30 +209,137 @@ def none(data):
     """Do nothing"""
     return np.zeros(data.shape[0],dtype='int16')
 
-def _metric_euclidean(data1, data2):
+def _row_norms(data):
+    """squared Euclidean norms of the rows of data"""
+    return np.einsum('ij,ij->i', data, data)
+
+def iter_metric_euclidean(data1, data2=None, squared=False, dtype=np.float64,
+                          max_memory=2**26, norms1=None, norms2=None, 
+                          center=True):
+    """Calculate Euclidean distances between rows of two arrays in
+    blocks of rows.
+    
+    Distances are calculated as ||a||^2 + ||b||^2 - 2ab, where the last
+    term is a matrix product. Only a single block of rows of the 
+    distance matrix is kept in memory at a time.
+    
+    Parameters
+    ----------
+    data1 : array
+        (n_pts1, n_dims) array
+    data2 : array, optional
+        (n_pts2, n_dims) array; by default distances between rows of
+        `data1` are calculated
+    squared : bool, optional
+        if True return squared distances
+    dtype : dtype, optional
+        data type of the calculations and of the results (float32
+        halves the memory)
+    max_memory : int, optional
+        maximum size of a block (in bytes)
+    norms1, norms2 : array, optional
+        precomputed squared norms of the rows of `data1` and `data2`
+    center : bool, optional
+        if True (and no norms are given) subtract the mean of `data2`
+        from both arrays to reduce round-off errors (distances do not
+        change)
+    
+    Yields
+    ------
+    start, stop : int
+        range of rows of `data1` in the block
+    block : array
+        (stop-start, n_pts2) block of the distance matrix
+    """
+    
+    same = data2 is None
+    if same:
+        data2, norms2 = data1, norms1
     n_pts1, n_dims1 = data1.shape
     n_pts2, n_dims2 = data2.shape
     if not n_dims1 == n_dims2:
         raise TypeError("data1 and data2 must have the same number of columns")
-    delta = np.zeros((n_pts1, n_pts2),'d')
-    for d in range(n_dims1):
-        _data1 = data1[:,d]
-        _data2 = data2[:,d]
-        _delta  = np.subtract.outer(_data1, _data2)**2
-        delta += _delta
-    return np.sqrt(delta)
-
-def dist_euclidean(spike_waves1, spike_waves2=None):
+    
+    data1 = np.asarray(data1, dtype=dtype)
+    data2 = data1 if same else np.asarray(data2, dtype=dtype)
+    if center and norms1 is None and norms2 is None and n_pts2 > 0:
+        offset = data2.mean(0)
+        data1 = data1 - offset
+        data2 = data1 if same else data2 - offset
+    if norms1 is None:
+        norms1 = _row_norms(data1)
+    if norms2 is None:
+        norms2 = norms1 if same else _row_norms(data2)
+    norms1 = np.asarray(norms1, dtype=dtype)
+    norms2 = np.asarray(norms2, dtype=dtype)
+    
+    itemsize = np.dtype(dtype).itemsize
+    block_rows = int(max(1, max_memory//(max(n_pts2, 1)*itemsize)))
+    for start in range(0, n_pts1, block_rows):
+        stop = min(start + block_rows, n_pts1)
+        block = np.dot(data1[start:stop], data2.T)
+        block *= -2
+        block += norms1[start:stop, np.newaxis]
+        block += norms2[np.newaxis, :]
+        np.maximum(block, 0, block)
+        if same:
+            i = np.arange(stop - start)
+            block[i, start + i] = 0
+        if not squared:
+            np.sqrt(block, block)
+        yield start, stop, block
+
+def metric_euclidean(data1, data2=None, squared=False, dtype=np.float64,
+                     max_memory=2**26, norms1=None, norms2=None, 
+                     center=True):
+    """Euclidean distances between rows of two arrays.
+    
+    See :py:func:`iter_metric_euclidean` for the description of the
+    parameters. `max_memory` limits only the size of temporary arrays,
+    the returned distance matrix is always (n_pts1, n_pts2).
+    """
+    n_pts2 = data1.shape[0] if data2 is None else data2.shape[0]
+    dist = np.empty((data1.shape[0], n_pts2), dtype=dtype)
+    for start, stop, block in iter_metric_euclidean(data1, data2, squared,
+                                                    dtype, max_memory,
+                                                    norms1, norms2, center):
+        dist[start:stop] = block
+    return dist
+
+def _metric_euclidean(data1, data2):
+    return metric_euclidean(data1, data2)
+
+def _waves2vectors(spike_waves):
+    """(n_spikes, n_pts*n_contacts) array of concatenated waveforms"""
+    sp_data = spike_waves['data']
+    if sp_data.ndim < 3:
+        sp_data = sp_data[:, :, np.newaxis]
+    return np.concatenate(sp_data, 1)
+
+def iter_dist_euclidean(spike_waves1, spike_waves2=None, **kwargs):
+    """Calculate pairwise Euclidean distance between spike waveforms in 
+    blocks of rows (see :py:func:`iter_metric_euclidean` for keyword 
+    arguments)"""
+    
+    sp_data1 = _waves2vectors(spike_waves1)
+    sp_data2 = None
+    if spike_waves2 is not None:
+        sp_data2 = _waves2vectors(spike_waves2)
+    return iter_metric_euclidean(sp_data1, sp_data2, **kwargs)
+
+def dist_euclidean(spike_waves1, spike_waves2=None, dtype=np.float64,
+                   max_memory=2**26):
     """Given spike_waves calculate pairwise Euclidean distance between
     them"""
 
-    sp_data1 = np.concatenate(spike_waves1['data'],1)
+    sp_data1 = _waves2vectors(spike_waves1)
     
     if spike_waves2 is None:
-        sp_data2 = sp_data1
+        sp_data2 = None
     else:
-        sp_data2 = np.concatenate(spike_waves2['data'],1)
-    d = _metric_euclidean(sp_data1, sp_data2)
+        sp_data2 = _waves2vectors(spike_waves2)
+    d = metric_euclidean(sp_data1, sp_data2, dtype=dtype, 
+                         max_memory=max_memory)
 
     return d
 
@@ -113,6 +348,9 @@ def cluster(method, features,  *args, **kwargs):
     
     Parameters
     ----------
+    method : str or callable
+        name of a registered clustering method (see 
+        :py:func:`list_methods`) or a clustering function
     features : dict
         spike features datastructure
     n_clusters : int
@@ -141,13 +379,10 @@ def cluster(method, features,  *args, **kwargs):
     >>> print labels
     [0 1 1 0]
     """
-    try:
-        
-        cluster_func = eval(method)
-    except NameError:
-        raise NotImplementedError(
-                    "clustering method %s is not implemented" % method
-                    )
+    if callable(method):
+        cluster_func = method
+    else:
+        cluster_func = get_method(method)
     
     data = features['data']
     mask = features.get('is_valid')
@@ -161,7 +396,471 @@ def cluster(method, features,  *args, **kwargs):
         
     return labels
 
-def k_means(features, K):
+def _stratified_sample(n_pts, n_samples, rng):
+    """Draw `n_samples` sorted indices, one from each of `n_samples`
+    equal consecutive strata of range(n_pts)"""
+    edges = np.arange(n_samples + 1)*(n_pts/float(n_samples))
+    edges = edges.astype(int)
+    widths = np.diff(edges)
+    return edges[:-1] + (rng.rand(n_samples)*widths).astype(int)
+
+def _nearest_centroid(data, labels):
+    """Return function assigning points to the label of the nearest
+    centroid of the labeled `data`"""
+    label_ids, inv = np.unique(labels, return_inverse=True)
+    sums, counts = _cluster_sums(data, inv, len(label_ids))
+    centroids = sums/counts[:, np.newaxis]
+    def predict(points):
+        points = _as_float(points)
+        dist = _sq_dist(points, centroids.astype(points.dtype))
+        return label_ids[dist.argmin(1)]
+    return predict
+
+def cluster_subsample(method, features, fit_size, *args, **kwargs):
+    """Cluster a subsample of spikes and assign the remaining spikes to
+    the identified clusters
+    
+    The clustering method is fitted on `fit_size` spikes sampled evenly
+    over the (time-ordered) recording: one spike is drawn at random from
+    each of `fit_size` consecutive bins of spikes. All spikes are then
+    assigned in blocks by the `predict` method of the model registered
+    with the method (see :py:func:`register_method`) or, if there is no
+    model, to the nearest cluster centroid. 
+    
+    Parameters
+    ----------
+    method : str or callable
+        name of a registered clustering method or a clustering function
+    features : dict
+        spike features datastructure
+    fit_size : int
+        number of spikes used for fitting; if there are fewer valid
+        spikes, all are clustered with :py:func:`cluster`
+    args, kwargs :
+        optional arguments that are passed to the clustering algorithm;
+        `seed` (if given) also seeds the sampling
+     
+    Returns
+    -------
+    labels : array
+        array of cluster (unit) label - one for each spike (-1 for
+        invalid spikes)
+    """
+    data = features['data']
+    mask = features.get('is_valid')
+    if mask is None:
+        valid_idx = np.arange(data.shape[0])
+    else:
+        valid_idx = np.nonzero(mask)[0]
+    fit_size = int(fit_size)
+    if len(valid_idx) <= fit_size:
+        return cluster(method, features, *args, **kwargs)
+    
+    rng = _check_random_state(kwargs.get('seed'))
+    sample_idx = valid_idx[_stratified_sample(len(valid_idx), fit_size, 
+                                              rng)]
+    sample = data[sample_idx, :]
+    
+    model = None
+    if not callable(method):
+        model = get_model(method)
+    if model is not None:
+        predict = model(*args, **kwargs).fit(sample).predict
+    else:
+        cluster_func = method if callable(method) else get_method(method)
+        sample_labels = np.asarray(cluster_func(sample, *args, **kwargs))
+        predict = _nearest_centroid(sample, sample_labels)
+    
+    labels = np.zeros(data.shape[0], dtype='int')-1
+    block_size = 65536
+    for start in range(0, len(valid_idx), block_size):
+        block_idx = valid_idx[start:start+block_size]
+        labels[block_idx] = predict(data[block_idx, :])
+    return labels
+
+def _label_moments(data, inv, n_labels, covariance=True, reg_covar=1e-6):
+    """Counts, means and (regularized) covariances of points with
+    labels `inv` (integers in range(n_labels))"""
+    sums, counts = _cluster_sums(data, inv, n_labels)
+    means = sums/np.maximum(counts, 1)[:, np.newaxis]
+    if not covariance:
+        return counts, means, None
+    n_features = data.shape[1]
+    reg = reg_covar*max(data.var(0).mean(), np.finfo(float).tiny)
+    covars = np.empty((n_labels, n_features, n_features))
+    for k in range(n_labels):
+        centered = data[inv==k, :] - means[k]
+        covars[k] = np.dot(centered.T, centered)/max(counts[k]-1, 1)
+        covars[k] += reg*np.eye(n_features)
+    return counts, means, covars
+
+def cluster_warm(method, features, labels, *args, **kwargs):
+    """Repeat clustering starting from the current labels
+    
+    The model of the method (see :py:func:`get_model`) is initialized 
+    with the means (and covariances and weights for mixture models) of
+    the labeled spikes and iterated until it converges again. If the
+    clusters did not change much (for example, after adding a feature
+    or changing the detection threshold slightly) this takes only a few
+    iterations and the spikes keep their labels.
+    
+    Parameters
+    ----------
+    method : str
+        name of a registered clustering method with a model (for 
+        example 'k_means' or 'gmm')
+    features : dict
+        spike features datastructure
+    labels : array
+        current labels of the spikes; spikes with negative labels (for
+        example, deleted spikes) are left out
+    args, kwargs :
+        optional arguments of the model (without the number of 
+        clusters, which is given by the number of distinct labels)
+    
+    Returns
+    -------
+    labels : array
+        new labels of spikes (-1 for the left out and invalid spikes)
+    """
+    model = get_model(method) if not callable(method) else None
+    if model is None:
+        raise NotImplementedError("method %s does not support warm "
+                                  "start" % method)
+    data = features['data']
+    labels = np.asarray(labels)
+    if len(labels) != data.shape[0]:
+        raise ValueError("labels must be given for all spikes")
+    mask = labels >= 0
+    if features.get('is_valid') is not None:
+        mask &= features['is_valid']
+    idx = np.nonzero(mask)[0]
+    label_ids, inv = np.unique(labels[idx], return_inverse=True)
+    
+    fit_data = np.asarray(data[idx, :], dtype=np.float64)
+    model = model(len(label_ids), *args, **kwargs)
+    counts, means, covars = _label_moments(fit_data, inv, len(label_ids))
+    if getattr(model, 'cov_type', 'full') == 'diag':
+        covars = np.diagonal(covars, axis1=1, axis2=2).copy()
+    model.init = {'means': means, 'covars': covars, 
+                  'weights': counts/float(counts.sum())}
+    model.fit(data[idx, :])
+    
+    new_labels = np.zeros(data.shape[0], dtype='int')-1
+    new_labels[idx] = label_ids[model.predict(data[idx, :])]
+    return new_labels
+
+def _check_random_state(seed):
+    """Return random generator: global numpy generator for None, new
+    generator for an int seed or `seed` itself if it is already a 
+    generator"""
+    if seed is None:
+        return np.random.mtrand._rand
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+def _as_float(data):
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float64)
+    return data
+
+def _sq_dist(data, centers, data_sq=None):
+    """Squared Euclidean distances between data points and centers"""
+    if data_sq is None:
+        data_sq = _row_norms(data)
+    return metric_euclidean(data, centers, squared=True, dtype=data.dtype,
+                            norms1=data_sq, norms2=_row_norms(centers),
+                            center=False)
+
+def _k_means_plus_plus(data, K, rng, data_sq=None):
+    """Choose initial centers: each new center is drawn with 
+    probability proportional to the squared distance from the nearest 
+    of the centers already chosen. Of several such candidates the one
+    that decreases the total distance most is kept."""
+    n_pts = data.shape[0]
+    if data_sq is None:
+        data_sq = _row_norms(data)
+    n_trials = 2 + int(np.log(K))
+    centers = np.empty((K, data.shape[1]), dtype=data.dtype)
+    centers[0] = data[rng.randint(n_pts)]
+    closest = _sq_dist(data, centers[:1], data_sq)[:, 0]
+    for k in range(1, K):
+        cumsum = np.cumsum(closest)
+        if cumsum[-1] > 0:
+            candidates = np.searchsorted(cumsum, 
+                                    rng.random_sample(n_trials)*cumsum[-1])
+            candidates = np.minimum(candidates, n_pts - 1)
+        else:
+            candidates = rng.randint(n_pts, size=n_trials)
+        dist = _sq_dist(data, data[candidates], data_sq)
+        np.minimum(dist, closest[:, np.newaxis], dist)
+        best = dist.sum(0).argmin()
+        centers[k] = data[candidates[best]]
+        closest = dist[:, best]
+    return centers
+
+def _fit_worker(model, data=None):
+    if data is None:
+        data = _worker_data
+    return model.fit(data)
+
+def fit_restarts(model, data, objective, maximize=True):
+    """Fit a model several times with different random initializations
+    and keep the best run
+    
+    Unless `model.n_jobs` is 1, the runs are started in a pool of
+    `model.n_jobs` processes (the data are sent to each process only
+    once). Seeds of the runs are drawn from `model.seed`, so the
+    results are reproducible.
+    
+    Parameters
+    ----------
+    model : object
+        model with `seed`, `n_init` and `n_jobs` attributes and a `fit`
+        method
+    data : array
+        (n_points, n_features) data array
+    objective : str
+        name of the model attribute with the objective of the fit
+    maximize : bool
+        True if higher `objective` is better
+    
+    Returns
+    -------
+    model : object
+        the model updated with the parameters of the best run; `scores`
+        and `seeds` attributes contain objectives and seeds of all runs
+    """
+    rng = _check_random_state(model.seed)
+    seeds = rng.randint(np.iinfo(np.int32).max, size=model.n_init)
+    runs = []
+    for run_seed in seeds:
+        run = copy.copy(model)
+        run.seed, run.n_init = run_seed, 1
+        runs.append(run)
+    
+    if model.n_jobs == 1:
+        runs = [run.fit(data) for run in runs]
+    else:
+        with futures.ProcessPoolExecutor(model.n_jobs, 
+                                         initializer=_init_model_worker,
+                                         initargs=(data,)) as executor:
+            jobs = [executor.submit(_fit_worker, run) for run in runs]
+            runs = [job.result() for job in jobs]
+    
+    scores = np.array([getattr(run, objective) for run in runs])
+    best = scores.argmax() if maximize else scores.argmin()
+    params = runs[best].__dict__.copy()
+    params.update(seed=model.seed, n_init=model.n_init)
+    model.__dict__.update(params)
+    model.scores, model.seeds = scores, seeds
+    return model
+
+def _cluster_sums(data, labels, K):
+    """Sum of data points and number of points in each cluster"""
+    counts = np.bincount(labels, minlength=K)
+    sums = np.empty((K, data.shape[1]), dtype=np.float64)
+    for j in range(data.shape[1]):
+        sums[:, j] = np.bincount(labels, weights=data[:, j], minlength=K)
+    return sums, counts
+
+class KMeans(object):
+    """K means clustering
+    
+    Parameters
+    ----------
+    n_clusters : int
+        number of clusters
+    init : 'k-means++', 'random', array or dict
+        method of initialization: 'k-means++' (default) seeds centers
+        far from each other, 'random' uses randomly selected data 
+        points; an array of shape (n_clusters, n_features) (or a dict
+        with such array under 'means' key) gives the initial centers
+    tol : float
+        relative tolerance: iterations stop when the squared shift of
+        centers is lower than `tol` times mean variance of the data
+    max_iter : int
+        maximum number of iterations
+    seed : None, int or RandomState
+        random generator or its seed; by default numpy global generator
+        is used
+    n_init : int
+        number of runs with different initializations; the run with the
+        lowest inertia is kept (see :py:func:`fit_restarts`)
+    n_jobs : int or None
+        number of processes used for the runs; by default all runs are
+        fitted in the calling process, None uses all CPUs
+    
+    Attributes
+    ----------
+    centers : array
+        (n_clusters, n_features) cluster centers
+    labels : array
+        cluster labels of the fitted data points
+    inertia : float
+        sum of squared distances of points to their cluster centers
+    n_iter : int
+        number of iterations run
+    scores, seeds : array
+        inertia and seeds of all runs (only if `n_init` > 1)
+    """
+    
+    def __init__(self, n_clusters, init='k-means++', tol=1e-4, 
+                 max_iter=300, seed=None, n_init=1, n_jobs=1):
+        self.n_clusters = n_clusters
+        self.init = init
+        self.tol = tol
+        self.max_iter = max_iter
+        self.seed = seed
+        self.n_init = n_init
+        self.n_jobs = n_jobs
+        self.centers = None
+    
+    def _init_centers(self, data, rng, data_sq):
+        K = self.n_clusters
+        if isinstance(self.init, str):
+            if self.init == 'k-means++':
+                return _k_means_plus_plus(data, K, rng, data_sq)
+            elif self.init == 'random':
+                return data[rng.permutation(data.shape[0])[:K]].copy()
+            raise ValueError("unknown initialization method %s" % self.init)
+        init = self.init
+        if isinstance(init, dict):
+            init = init['means']
+        centers = np.array(init, dtype=data.dtype)
+        if centers.shape != (K, data.shape[1]):
+            raise ValueError("initial centers must be an array of shape"
+                             " (n_clusters, n_features)")
+        return centers
+    
+    def _tolerance(self, data):
+        return self.tol*np.mean(np.var(data, 0))
+    
+    def fit(self, data):
+        """Cluster data of shape (n_points, n_features)"""
+        if self.n_init > 1:
+            return fit_restarts(self, data, 'inertia', maximize=False)
+        return self._fit_single(data)
+    
+    def _fit_single(self, data):
+        data = _as_float(data)
+        K = self.n_clusters
+        if data.shape[0] < K:
+            raise ValueError("number of points must be larger than the"
+                             " number of clusters")
+        rng = _check_random_state(self.seed)
+        data_sq = _row_norms(data)
+        centers = self._init_centers(data, rng, data_sq)
+        tol = self._tolerance(data)
+        
+        for n_iter in range(1, self.max_iter + 1):
+            dist = _sq_dist(data, centers, data_sq)
+            labels = dist.argmin(1)
+            sums, counts = _cluster_sums(data, labels, K)
+            empty, = np.nonzero(counts == 0)
+            new_centers = sums/np.maximum(counts, 1)[:, np.newaxis]
+            if len(empty):
+                #reseed empty clusters with points farthest from their
+                #centers
+                min_dist = dist[np.arange(len(labels)), labels]
+                far = np.argsort(min_dist)[::-1][:len(empty)]
+                new_centers[empty] = data[far]
+            new_centers = new_centers.astype(data.dtype)
+            shift = ((new_centers - centers)**2).sum()
+            centers = new_centers
+            if shift <= tol and not len(empty):
+                break
+        
+        dist = _sq_dist(data, centers, data_sq)
+        self.labels = dist.argmin(1)
+        self.inertia = dist[np.arange(len(self.labels)), self.labels].sum()
+        self.centers = centers
+        self.n_iter = n_iter
+        return self
+    
+    def predict(self, data):
+        """Assign points to the nearest cluster center"""
+        data = _as_float(data)
+        return _sq_dist(data, self.centers.astype(data.dtype)).argmin(1)
+
+class MiniBatchKMeans(KMeans):
+    """K means clustering with center updates on random mini-batches
+    of points. It is much faster than :py:class:`KMeans` for large
+    numbers of points.
+    
+    Parameters
+    ----------
+    batch_size : int
+        number of points in a mini-batch
+    max_iter : int
+        maximum number of mini-batches
+        
+    Other parameters and attributes are the same as for 
+    :py:class:`KMeans`. Iterations stop, when squared shift of the
+    centers averaged over last mini-batches falls below tolerance.
+    """
+    
+    def __init__(self, n_clusters, init='k-means++', tol=1e-4, 
+                 max_iter=100, seed=None, batch_size=1000, n_init=1,
+                 n_jobs=1):
+        super(MiniBatchKMeans, self).__init__(n_clusters, init, tol, 
+                                              max_iter, seed, n_init, 
+                                              n_jobs)
+        self.batch_size = batch_size
+    
+    def _fit_single(self, data):
+        data = _as_float(data)
+        K = self.n_clusters
+        n_pts = data.shape[0]
+        if n_pts < K:
+            raise ValueError("number of points must be larger than the"
+                             " number of clusters")
+        rng = _check_random_state(self.seed)
+        batch_size = min(self.batch_size, n_pts)
+        
+        init_idx = rng.permutation(n_pts)[:min(3*batch_size, n_pts)]
+        centers = self._init_centers(data[init_idx], rng, None)
+        centers = centers.astype(np.float64)
+        tol = self._tolerance(data[init_idx])
+        counts = np.zeros(K)
+        ewa_shift = None
+        
+        for n_iter in range(1, self.max_iter + 1):
+            batch = data[rng.randint(0, n_pts, batch_size)]
+            labels = _sq_dist(batch, centers.astype(data.dtype)).argmin(1)
+            sums, batch_counts = _cluster_sums(batch, labels, K)
+            
+            #running mean of the points assigned to each center
+            new_counts = counts + batch_counts
+            new_centers = centers.copy()
+            upd = batch_counts > 0
+            new_centers[upd] = ((centers[upd]*counts[upd, np.newaxis] + 
+                                 sums[upd])/new_counts[upd, np.newaxis])
+            empty, = np.nonzero(new_counts == 0)
+            if len(empty):
+                new_centers[empty] = batch[rng.permutation(batch_size)
+                                           [:len(empty)]]
+            
+            shift = ((new_centers - centers)**2).sum()
+            centers, counts = new_centers, new_counts
+            if ewa_shift is None:
+                ewa_shift = shift
+            else:
+                ewa_shift = 0.8*ewa_shift + 0.2*shift
+            if ewa_shift <= tol and not len(empty):
+                break
+        
+        self.centers = centers.astype(data.dtype)
+        dist = _sq_dist(data, self.centers)
+        self.labels = dist.argmin(1)
+        self.inertia = dist[np.arange(n_pts), self.labels].sum()
+        self.n_iter = n_iter
+        return self
+
+def k_means(features, K, tol=1e-4, max_iter=300, seed=None, 
+            init='k-means++', n_init=1, n_jobs=1):
     """Perform K means clustering
     
     Parameters
@@ -171,6 +870,8 @@ def k_means(features, K):
         the number of variables
     K : int
         number of distinct clusters to identify
+    tol, max_iter, seed, init, n_init, n_jobs : 
+        see :py:class:`KMeans`
      
     Returns
     -------
@@ -178,22 +879,345 @@ def k_means(features, K):
         vector of cluster labels (ints) for each datapoint from `data`
     """
     
-    n_dim = features.shape[1]
-    centers = np.random.rand(K, n_dim)
-    centers_new = np.random.rand(K, n_dim)
-    partition = np.zeros(features.shape[0], dtype=np.int)
-    while not (centers_new == centers).all():
-        centers = centers_new.copy()
+    model = _k_means_model(K, tol, max_iter, seed, init, n_init, n_jobs)
+    return model.fit(features).labels
+
+def _k_means_model(K, tol=1e-4, max_iter=300, seed=None, init='k-means++',
+                   n_init=1, n_jobs=1):
+    return KMeans(K, init=init, tol=tol, max_iter=max_iter, seed=seed,
+                  n_init=n_init, n_jobs=n_jobs)
+
+def mini_batch_k_means(features, K, batch_size=1000, tol=1e-4, 
+                       max_iter=100, seed=None, init='k-means++', 
+                       n_init=1, n_jobs=1):
+    """Perform mini-batch K means clustering (suitable for very large
+    numbers of spikes)
+    
+    Parameters
+    ----------
+    data : dict
+        data vectors (n,m) where n is the number of datapoints and m is 
+        the number of variables
+    K : int
+        number of distinct clusters to identify
+    batch_size, tol, max_iter, seed, init, n_init, n_jobs : 
+        see :py:class:`MiniBatchKMeans`
+     
+    Returns
+    -------
+    partition : array
+        vector of cluster labels (ints) for each datapoint from `data`
+    """
+    
+    model = _mini_batch_k_means_model(K, batch_size, tol, max_iter, seed, 
+                                      init, n_init, n_jobs)
+    return model.fit(features).labels
+
+def _mini_batch_k_means_model(K, batch_size=1000, tol=1e-4, max_iter=100,
+                              seed=None, init='k-means++', n_init=1, 
+                              n_jobs=1):
+    return MiniBatchKMeans(K, init=init, tol=tol, max_iter=max_iter, 
+                           seed=seed, batch_size=batch_size, n_init=n_init,
+                           n_jobs=n_jobs)
+
+def _auto_eps(tree, data, min_samples, sample_size=10000, seed=None):
+    rng = _check_random_state(seed)
+    if len(data) > sample_size:
+        data = data[_stratified_sample(len(data), sample_size, rng), :]
+    k = min(min_samples, tree.n)
+    k_dist, _ = tree.query(data, k=k)
+    if k > 1:
+        k_dist = k_dist[:, -1]
+    return np.percentile(k_dist, 90)
+
+def dbscan(data, eps='auto', min_samples=5, min_cluster_size=None):
+    """Density-based clustering (DBSCAN)
+    
+    Spikes with at least `min_samples` neighbours (including the spike
+    itself) within distance `eps` are core spikes. Core spikes closer
+    than `eps` belong to the same cluster; other spikes are assigned to
+    the cluster of the closest core spike within `eps` or marked as
+    noise. The number of clusters is found automatically and the
+    clusters can have arbitrary shapes.
+    
+    Core and noise spikes are the same as in the standard algorithm
+    (for example, `sklearn.cluster.DBSCAN`), but a border spike within
+    `eps` of several clusters always goes to the nearest core spike
+    instead of the one visited first, so labels of such spikes may
+    differ.
+    
+    Neighbourhoods are found with a KD-tree, so the running time is
+    close to O(n log n) for low-dimensional features. 
+    
+    Parameters
+    ----------
+    data : array
+        (n_spikes, n_features) array of features
+    eps : float or 'auto'
+        radius of neighbourhoods; 'auto' takes the 90th percentile
+        of distances of spikes to their `min_samples`-th nearest
+        neighbour (estimated on a subsample)
+    min_samples : int
+        minimum number of spikes in the neighbourhood of a core spike
+    min_cluster_size : int, optional
+        clusters with fewer spikes are marked as noise, which removes
+        the small clusters found in sparse tails of the distributions
+        (but may also discard units with few spikes); by default all
+        clusters are kept
+    
+    Returns
+    -------
+    cl : int array
+        cluster indices (-1 for noise)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    tree = spatial.cKDTree(data)
+    if eps == 'auto':
+        eps = _auto_eps(tree, data, min_samples)
+    n_neighbours = tree.query_ball_point(data, eps, return_length=True)
+    core = n_neighbours >= min_samples
+    
+    labels = np.zeros(len(data), dtype=int) - 1
+    if not core.any():
+        return labels
+    core_idx = np.nonzero(core)[0]
+    core_tree = spatial.cKDTree(data[core_idx])
+    pairs = core_tree.query_pairs(eps, output_type='ndarray')
+    n_core = len(core_idx)
+    graph = sparse.coo_matrix((np.ones(len(pairs), dtype=bool), 
+                               (pairs[:, 0], pairs[:, 1])), 
+                              shape=(n_core, n_core))
+    _, core_labels = csgraph.connected_components(graph, directed=False)
+    labels[core_idx] = core_labels
+    
+    border_idx = np.nonzero(~core)[0]
+    if len(border_idx):
+        dist, nearest = core_tree.query(data[border_idx], k=1, 
+                                        distance_upper_bound=eps)
+        reached = np.isfinite(dist)
+        labels[border_idx[reached]] = core_labels[nearest[reached]]
+    
+    if min_cluster_size is not None and min_cluster_size > 1:
+        clustered = labels >= 0
+        sizes = np.bincount(labels[clustered])
+        keep = sizes >= min_cluster_size
+        new_ids = np.where(keep, np.cumsum(keep) - 1, -1)
+        labels[clustered] = new_ids[labels[clustered]]
+    return labels
+
+def silhouette_score(data, labels, sample_size=None, seed=None,
+                     max_memory=2**26):
+    """Mean silhouette coefficient of a clustering
+    
+    The silhouette of a point is (b-a)/max(a, b), where a is the mean
+    distance to the other points of its cluster and b is the mean
+    distance to the points of the nearest other cluster. Distances are
+    calculated in blocks, so the memory usage is bounded.
+    
+    Parameters
+    ----------
+    data : array
+        (n_points, n_features) data array
+    labels : array
+        cluster labels of the points 
+    sample_size : int, optional
+        if given, the score is estimated on a random subsample of points
+    seed : None, int or RandomState
+        random generator (or its seed) used for sampling
+    max_memory : int
+        approximate size (in bytes) of the distance blocks
+    
+    Returns
+    -------
+    score : float
+        silhouette score between -1 (wrong clustering) and 1 (dense,
+        well separated clusters)
+    """
+    data = np.asarray(data)
+    labels = np.asarray(labels)
+    if sample_size is not None and sample_size < len(labels):
+        rng = _check_random_state(seed)
+        idx = _stratified_sample(len(labels), int(sample_size), rng)
+        data, labels = data[idx, :], labels[idx]
+    label_ids, inv = np.unique(labels, return_inverse=True)
+    n_clusters = len(label_ids)
+    if n_clusters < 2:
+        return 0.
+    counts = np.bincount(inv, minlength=n_clusters).astype(np.float64)
+    
+    indicator = np.eye(n_clusters)[inv]
+    sil = np.empty(len(labels))
+    for start, stop, block in iter_metric_euclidean(data, 
+                                                max_memory=max_memory):
+        dist_sums = np.dot(block, indicator)
+        own = inv[start:stop]
+        rows = np.arange(stop-start)
+        a = dist_sums[rows, own]/np.maximum(counts[own]-1, 1)
+        dist_sums /= counts
+        dist_sums[rows, own] = np.inf
+        b = dist_sums.min(1)
+        sil_block = (b-a)/np.maximum(np.maximum(a, b), 1e-300)
+        sil_block[counts[own]==1] = 0
+        sil[start:stop] = sil_block
+    return sil.mean()
+
+_CRITERIA = {'bic' : -1, 'aic' : -1, 'silhouette' : 1}
+
+_worker_data = None
+
+def _init_model_worker(data):
+    global _worker_data
+    _worker_data = data
+
+def _score_model(factory, k, seed, criterion, sample, kwargs, data=None):
+    """Fit model created by `factory` with `k` clusters and return its
+    score and the fitted model"""
+    if data is None:
+        data = _worker_data
+    model = factory(k, seed=seed, **kwargs).fit(data)
+    if criterion == 'silhouette':
+        score = silhouette_score(data[sample, :], model.predict(data[sample]))
+    else:
+        score = getattr(model, criterion)(data)
+    return score, model
+
+def _model_score(factory, k, seed, criterion, sample, kwargs):
+    """Score of a model fitted in a worker process (the model itself is
+    not sent back)"""
+    return _score_model(factory, k, seed, criterion, sample, kwargs)[0]
+
+def select_model(data, k_range=range(2, 9), method='gmm', criterion='bic', 
+                 n_init=3, n_jobs=1, sample_size=2000, seed=None, 
+                 **kwargs):
+    """Fit clustering models with different number of clusters and
+    select the best one
+    
+    With `n_jobs` other than 1, models for all numbers of clusters and
+    restarts are fitted concurrently in a pool of processes (the data
+    are sent to each process only once). The processes return only the
+    scores and the best model is fitted again in the calling process,
+    so the model factory of `method` must be picklable.
+    
+    Parameters
+    ----------
+    data : array
+        (n_spikes, n_features) array of features
+    k_range : sequence of ints
+        candidate numbers of clusters
+    method : str
+        registered clustering method with a model factory (see
+        :py:func:`get_model`), for example 'gmm' or 'k_means'
+    criterion : {'bic', 'aic', 'silhouette'}
+        'bic' and 'aic' (lower is better) require a model with `bic` and 
+        `aic` methods such as gaussian mixtures; 'silhouette' (higher is
+        better, see :py:func:`silhouette_score`) is estimated on a 
+        subsample of `sample_size` spikes and works with all models
+    n_init : int
+        number of restarts (with different seeds) for each number of
+        clusters
+    n_jobs : int or None
+        number of processes; 1 (default) fits all models sequentially,
+        None uses all CPUs
+    sample_size : int
+        number of spikes used for the silhouette estimate
+    seed : None, int or RandomState
+        random generator (or its seed) from which seeds of the
+        restarts are drawn
+    kwargs :
+        optional arguments of the model
+    
+    Returns
+    -------
+    labels : array
+        cluster labels of the best model
+    scores : array
+        structured array with fields 'k', 'seed' and 'score', one record
+        for each fitted model
+    """
+    if criterion not in _CRITERIA:
+        raise ValueError("unknown criterion %s" % criterion)
+    factory = get_model(method)
+    if factory is None:
+        raise NotImplementedError("method %s does not support model "
+                                  "selection" % method)
+    data = np.asarray(data)
+    rng = _check_random_state(seed)
+    k_range = list(k_range)
+    seeds = rng.randint(np.iinfo(np.int32).max, size=(len(k_range), n_init))
+    sample = _stratified_sample(len(data), min(sample_size, len(data)), 
+                                rng)
+    
+    scores = np.zeros(len(k_range)*n_init, 
+                      dtype=[('k', int), ('seed', int), ('score', float)])
+    scores['k'] = np.repeat(k_range, n_init)
+    scores['seed'] = seeds.ravel()
+    
+    sign = _CRITERIA[criterion]
+    runs = list(zip(scores['k'], scores['seed']))
+    if n_jobs == 1:
+        results = (_score_model(factory, k, run_seed, criterion, sample, 
+                                kwargs, data) for k, run_seed in runs)
+        best_model = _keep_best(results, scores, sign)
+    else:
+        with futures.ProcessPoolExecutor(n_jobs, 
+                                         initializer=_init_model_worker,
+                                         initargs=(data,)) as executor:
+            jobs = [executor.submit(_model_score, factory, k, run_seed, 
+                                    criterion, sample, kwargs)
+                    for k, run_seed in runs]
+            for i, job in enumerate(jobs):
+                scores['score'][i] = job.result()
+        best = np.argmax(sign*scores['score'])
+        best_model = factory(int(scores['k'][best]), 
+                             seed=int(scores['seed'][best]), 
+                             **kwargs).fit(data)
+    
+    labels = best_model.predict(data)
+    return labels, scores
+
+def _keep_best(results, scores, sign):
+    """Store scores of (score, model) `results` and return the best
+    model (only the best one is kept in memory)"""
+    best_model, best_score = None, -np.inf
+    for i, (score, model) in enumerate(results):
+        scores['score'][i] = score
+        if best_model is None or sign*score > best_score:
+            best_model, best_score = model, sign*score
+    return best_model
+
+def auto(data, k_range=range(2, 9), method='gmm', criterion='bic', 
+         n_init=3, n_jobs=1, seed=None, **kwargs):
+    """Cluster with automatic selection of the number of clusters
+    
+    Parameters
+    ----------
+    data : array
+        (n_spikes, n_features) array of features
+    k_range, method, criterion, n_init, n_jobs, seed, kwargs : 
+        see :py:func:`select_model`
     
-        distances = (centers[:,np.newaxis,:] - features)
-        distances *= distances
-        distances = distances.sum(axis=2)
-        partition = distances.argmin(axis=0)
+    Returns
+    -------
+    cl : int array
+        cluster indicies
+    """
+    labels, _ = select_model(data, k_range, method, criterion, n_init,
+                             n_jobs, seed=seed, **kwargs)
+    return labels
 
-        for i in range(K):
-            if np.sum(partition==i)>0:
-                centers_new[i, :] = features[partition==i, :].mean(0)
-    return partition
+for _name, _func, _model in [
+                     ('k_means', k_means, _k_means_model), 
+                     ('mini_batch_k_means', mini_batch_k_means,
+                      _mini_batch_k_means_model),
+                     ('k_means_plus', k_means_plus, None),
+                     ('gmm', gmm, _gmm_model),
+                     ('sk_gmm', sk_gmm, None),
+                     ('manual', manual, None),
+                     ('none', none, None),
+                     ('auto', auto, None),
+                     ('dbscan', dbscan, None)]:
+    register_method(_name, _func, _model)
+del _name, _func, _model
 
 def split_cells(spt_dict, idx, which='all'):
     """return the spike times belonging to the cluster and the rest"""
@@ -207,3 +1231,466 @@ def split_cells(spt_dict, idx, which='all'):
     spt_dicts = dict([(cl, {'data': spt[idx==cl]}) for cl in classes])
 
     return spt_dicts
+
+def remap_labels(labels, mapping):
+    """Change cluster labels in a single pass using binary search over
+    the sorted old labels
+    
+    Parameters
+    ----------
+    labels : int array
+        cluster labels
+    mapping : dict
+        old label -> new label; labels that are not in `mapping` do not
+        change
+    
+    Returns
+    -------
+    labels : int array
+        new labels
+    """
+    labels = np.asarray(labels)
+    if not len(mapping) or not len(labels):
+        return labels.copy()
+    old = np.fromiter(mapping.keys(), dtype=int, count=len(mapping))
+    new = np.fromiter(mapping.values(), dtype=int, count=len(mapping))
+    order = np.argsort(old)
+    old, new = old[order], new[order]
+    pos = np.minimum(np.searchsorted(old, labels), len(old) - 1)
+    found = old[pos] == labels
+    return np.where(found, new[pos], labels).astype(labels.dtype)
+
+def _unique_labels(labels):
+    """Sorted unique labels (faster than np.unique for small 
+    non-negative ints)"""
+    labels = np.asarray(labels)
+    if len(labels) and labels.min() >= 0 and labels.max() < 4*len(labels):
+        return np.nonzero(np.bincount(labels))[0]
+    return np.unique(labels)
+
+class LabelAllocator(object):
+    """Allocator of unused cluster labels
+    
+    Labels are allocated starting from the smallest unused label
+    (greater than or equal to `start`) without any upper limit.
+    
+    Parameters
+    ----------
+    used : sequence of ints
+        labels that are already in use
+    start : int
+        smallest label that can be allocated
+    """
+    def __init__(self, used=(), start=1):
+        self.used = set(int(l) for l in used)
+        self.start = start
+        
+    @classmethod
+    def from_labels(cls, labels, start=1):
+        """Create allocator of labels not present in the `labels` 
+        array"""
+        return cls(_unique_labels(labels), start)
+    
+    def allocate(self, n=1):
+        """Return list of `n` unused labels and mark them as used"""
+        new_labels = []
+        label = self.start
+        while len(new_labels) < n:
+            if label not in self.used:
+                new_labels.append(label)
+            label += 1
+        self.used.update(new_labels)
+        return new_labels
+    
+    def release(self, *labels):
+        """Mark labels as unused"""
+        self.used.difference_update(labels)
+
+class ClusterStats(object):
+    """Sufficient statistics of clusters in the feature space
+    
+    For each label the number of spikes, the sum and the sum of squares
+    of their features (and optionally the sum of cross-products) are
+    kept. The statistics are updated incrementally when spikes change
+    their labels or clusters are merged, so that summaries (counts,
+    means, variances, covariances) are obtained without reading the
+    features of all spikes.
+    
+    Parameters
+    ----------
+    n_features : int
+        number of features
+    covariance : bool
+        if True, keep also the cross-products needed for covariances
+    """
+    
+    def __init__(self, n_features, covariance=False):
+        self.n_features = n_features
+        self.covariance = covariance
+        self._counts = {}
+        self._sums = {}
+        self._sumsq = {}
+        self._cross = {}
+    
+    @classmethod
+    def from_labels(cls, data, labels, covariance=False):
+        """Calculate statistics of spikes with features `data` and 
+        cluster `labels`"""
+        stats = cls(np.shape(data)[1], covariance)
+        stats.add(data, labels)
+        return stats
+    
+    def _grouped(self, data, labels):
+        data = np.asarray(data, dtype=np.float64)
+        labels = np.asarray(labels)
+        if labels.ndim == 0:
+            labels = np.repeat(labels, data.shape[0])
+        label_ids, inv = np.unique(labels, return_inverse=True)
+        n_labels = len(label_ids)
+        sums, counts = _cluster_sums(data, inv, n_labels)
+        sumsq, _ = _cluster_sums(data**2, inv, n_labels)
+        cross = [None]*n_labels
+        if self.covariance:
+            for k in range(n_labels):
+                group = data[inv==k, :]
+                cross[k] = np.dot(group.T, group)
+        return zip(label_ids, counts, sums, sumsq, cross)
+    
+    def add(self, data, labels):
+        """Add spikes with features `data` to clusters `labels`"""
+        for label, count, sums, sumsq, cross in self._grouped(data, labels):
+            if label in self._counts:
+                self._counts[label] += count
+                self._sums[label] += sums
+                self._sumsq[label] += sumsq
+                if self.covariance:
+                    self._cross[label] += cross
+            else:
+                self._counts[label] = count
+                self._sums[label] = sums
+                self._sumsq[label] = sumsq
+                self._cross[label] = cross
+    
+    def remove(self, data, labels):
+        """Remove spikes with features `data` from clusters `labels`"""
+        for label, count, sums, sumsq, cross in self._grouped(data, labels):
+            self._counts[label] -= count
+            if self._counts[label] <= 0:
+                self._drop(label)
+                continue
+            self._sums[label] -= sums
+            self._sumsq[label] -= sumsq
+            if self.covariance:
+                self._cross[label] -= cross
+    
+    def move(self, data, old_labels, new_labels):
+        """Move spikes with features `data` between clusters"""
+        self.remove(data, old_labels)
+        self.add(data, new_labels)
+    
+    def _drop(self, label):
+        for stat in (self._counts, self._sums, self._sumsq, self._cross):
+            stat.pop(label, None)
+    
+    def merge(self, labels, target):
+        """Merge clusters `labels` into cluster `target`"""
+        for label in labels:
+            if label == target or label not in self._counts:
+                continue
+            if target not in self._counts:
+                self.rename({label: target})
+                continue
+            self._counts[target] += self._counts[label]
+            self._sums[target] += self._sums[label]
+            self._sumsq[target] += self._sumsq[label]
+            if self.covariance:
+                self._cross[target] += self._cross[label]
+            self._drop(label)
+    
+    def rename(self, mapping):
+        """Change labels of clusters given by `mapping` 
+        (dict old label -> new label); the new labels must not be used by
+        other clusters"""
+        stats = (self._counts, self._sums, self._sumsq, self._cross)
+        old_labels = [old for old in mapping if old in self._counts]
+        moved = [[stat.pop(old) for stat in stats] for old in old_labels]
+        for new, values in zip([mapping[old] for old in old_labels], moved):
+            for stat, value in zip(stats, values):
+                stat[new] = value
+    
+    @property
+    def labels(self):
+        """sorted labels of non-empty clusters"""
+        return sorted(self._counts)
+    
+    def count(self, label):
+        """Number of spikes in cluster `label`"""
+        return self._counts.get(label, 0)
+    
+    def mean(self, label):
+        """Mean features of cluster `label`"""
+        return self._sums[label]/self._counts[label]
+    
+    def var(self, label):
+        """Variances of features of cluster `label`"""
+        mean = self.mean(label)
+        return np.maximum(self._sumsq[label]/self._counts[label] - mean**2,
+                          0)
+    
+    def cov(self, label):
+        """Covariance matrix of features of cluster `label`"""
+        if not self.covariance:
+            raise ValueError("statistics do not include cross-products")
+        mean = self.mean(label)
+        return self._cross[label]/self._counts[label] - np.outer(mean, mean)
+    
+    def summary(self):
+        """Return dict with labels, counts, means and standard
+        deviations (arrays with one row per cluster)"""
+        labels = self.labels
+        if not labels:
+            return {'labels': np.array([], dtype=int), 
+                    'counts': np.array([], dtype=int),
+                    'means': np.zeros((0, self.n_features)),
+                    'stds': np.zeros((0, self.n_features))}
+        return {'labels': np.array(labels),
+                'counts': np.array([self._counts[l] for l in labels]),
+                'means': np.array([self.mean(l) for l in labels]),
+                'stds': np.sqrt([self.var(l) for l in labels])}
+
+class ClusterModel(object):
+    """Model of sorted cells used to assign spikes of new recordings
+    (for example, later sessions recorded with a chronic implant) to
+    the same cells without clustering them from scratch.
+    
+    Each cell is described by the mean and (optionally) covariance of
+    its features. Spikes are assigned to the closest cell (in
+    Mahalanobis distance if covariances are present, otherwise in
+    Euclidean distance). Spikes whose distance to the closest cell
+    exceeds `threshold` are not matched to any cell and receive
+    `trash_label`.
+    
+    The model also keeps the definitions of features and the feature
+    normalization, so that the features of new spikes are calculated in
+    the same way (see :py:meth:`sort`). Features depending on the whole
+    data set (such as principal components) are recalculated on the
+    new data, so features with fixed definitions (peak-to-peak
+    amplitudes, wavelet coefficients, projections) should be preferred.
+    
+    Parameters
+    ----------
+    labels : array
+        (n_cells,) labels of the cells
+    means : array
+        (n_cells, n_features) feature means of the cells
+    covars : array, optional
+        (n_cells, n_features, n_features) feature covariances of the 
+        cells
+    names : list, optional
+        names of the features
+    threshold : float, optional
+        maximum (squared) distance of a spike to the cell it is assigned
+        to; None matches all spikes
+    normalizer : :py:class:`spike_sort.core.features.Normalizer`, optional
+        normalization applied to the calculated features
+    feature_specs : list, optional
+        list of (function_name, args, kwargs) triples of feature
+        functions (see :py:func:`spike_sort.core.features.calc_features`)
+    trash_label : int
+        label of unmatched spikes
+    """
+    
+    def __init__(self, labels, means, covars=None, names=None, 
+                 threshold=None, normalizer=None, feature_specs=None,
+                 trash_label=0):
+        self.labels = np.asarray(labels)
+        self.means = np.asarray(means, dtype=np.float64)
+        self.covars = None
+        if covars is not None:
+            self.covars = np.asarray(covars, dtype=np.float64)
+            self._prec_chol = np.linalg.inv(np.linalg.cholesky(self.covars))
+        self.names = None if names is None else list(names)
+        self.threshold = threshold
+        self.normalizer = normalizer
+        self.feature_specs = feature_specs
+        self.trash_label = trash_label
+        
+    @classmethod
+    def from_labels(cls, features, labels, trash_label=0, covariance=True,
+                    alpha=1e-3, reg_covar=1e-6, **kwargs):
+        """Build the model from sorted spikes
+        
+        Parameters
+        ----------
+        features : dict
+            features of the sorted spikes
+        labels : array
+            cell labels of spikes (spikes with `trash_label` and invalid
+            spikes are ignored)
+        trash_label : int
+            label of unsorted spikes
+        covariance : bool
+            if True, calculate covariances of cells and use Mahalanobis
+            distance for assignment
+        alpha : float, optional
+            fraction of spikes of a gaussian cluster that are allowed to
+            be rejected as novel; it sets the threshold to the
+            corresponding quantile of chi-square distribution (only with
+            `covariance`)
+        reg_covar : float
+            regularization of covariances relative to the average
+            feature variance
+        kwargs :
+            other arguments of :py:class:`ClusterModel` 
+        """
+        data = np.asarray(features['data'], dtype=np.float64)
+        labels = np.asarray(labels)
+        mask = labels != trash_label
+        if features.get('is_valid') is not None:
+            mask &= features['is_valid']
+        data, labels = data[mask, :], labels[mask]
+        cell_ids, inv = np.unique(labels, return_inverse=True)
+        n_cells, n_features = len(cell_ids), data.shape[1]
+        if n_cells == 0:
+            raise ValueError("there are no sorted spikes")
+        _, means, covars = _label_moments(data, inv, n_cells, covariance,
+                                          reg_covar)
+        if covariance and alpha is not None:
+            kwargs.setdefault('threshold', special.chdtri(n_features, alpha))
+        kwargs.setdefault('names', features.get('names'))
+        return cls(cell_ids, means, covars, trash_label=trash_label, 
+                   **kwargs)
+    
+    def _get_data(self, features):
+        if self.names is None or list(features['names']) == self.names:
+            return np.asarray(features['data'])
+        return _features.select(features, self.names)['data']
+    
+    def distances(self, features):
+        """Return (n_spikes, n_cells) array of squared distances of
+        spikes to the cells"""
+        data = self._get_data(features)
+        dist = np.empty((data.shape[0], len(self.labels)))
+        block_size = 65536
+        for start in range(0, data.shape[0], block_size):
+            block = np.asarray(data[start:start+block_size], 
+                               dtype=np.float64)
+            if self.covars is None:
+                dist[start:start+block_size] = _sq_dist(block, self.means)
+                continue
+            for k in range(len(self.labels)):
+                y = np.dot(block - self.means[k], self._prec_chol[k].T)
+                dist[start:start+block_size, k] = np.einsum('ij,ij->i', 
+                                                            y, y)
+        return dist
+    
+    def predict(self, features, return_score=False):
+        """Assign spikes to the cells
+        
+        Parameters
+        ----------
+        features : dict
+            features of spikes (normalized in the same way as the
+            features from which the model was built)
+        return_score : bool
+            if True, return also the novelty scores
+        
+        Returns
+        -------
+        labels : array
+            cell labels (`trash_label` for unmatched and invalid spikes)
+        score : array
+            squared distance of each spike to the closest cell (only if
+            `return_score` is True)
+        """
+        dist = self.distances(features)
+        closest = dist.argmin(1)
+        score = dist[np.arange(len(closest)), closest]
+        labels = self.labels[closest]
+        if self.threshold is not None:
+            labels[score > self.threshold] = self.trash_label
+        if features.get('is_valid') is not None:
+            labels[~np.asarray(features['is_valid'], dtype=bool)] = \
+                self.trash_label
+        if return_score:
+            return labels, score
+        return labels
+    
+    def calc_features(self, spikes_data, **kwargs):
+        """Calculate and normalize features of spikes as specified by 
+        `feature_specs` and `normalizer` (kwargs are passed to
+        :py:func:`spike_sort.core.features.calc_features`)"""
+        if self.feature_specs is None:
+            raise ValueError("the model does not define features")
+        feats = _features.calc_features(spikes_data, self.feature_specs,
+                                        **kwargs)
+        #the same data type as features of FeatureExtractor
+        feature_data = _features.combine(feats, norm=False, 
+                                         dtype=np.float32)
+        if self.normalizer is not None:
+            #the fitted normalization of the training features; 
+            #normalizing by the range of the new batch would move the
+            #spikes away from the clusters
+            return self.normalizer.transform(feature_data, copy=False)
+        return feature_data
+    
+    def sort(self, spikes_data, **kwargs):
+        """Calculate features of spikes and assign them to the cells"""
+        return self.predict(self.calc_features(spikes_data, **kwargs))
+    
+    def get_state(self):
+        """Return parameters of the model as a dict of arrays"""
+        state = {'labels': self.labels, 
+                 'means': self.means,
+                 'trash_label': self.trash_label}
+        if self.covars is not None:
+            state['covars'] = self.covars
+        if self.names is not None:
+            state['names'] = np.array(self.names)
+        if self.threshold is not None:
+            state['threshold'] = self.threshold
+        if self.feature_specs is not None:
+            try:
+                state['feature_specs'] = json.dumps(
+                    [[name, list(args), kwargs] 
+                     for name, args, kwargs in self.feature_specs])
+            except TypeError:
+                raise ValueError("feature arguments can not be saved")
+        if self.normalizer is not None:
+            for key, value in self.normalizer.get_state().items():
+                state['normalizer_' + key] = value
+        return state
+    
+    @classmethod
+    def from_state(cls, state):
+        """Create a model from parameters returned by `get_state`"""
+        normalizer = None
+        norm_state = dict([(key[len('normalizer_'):], value) 
+                           for key, value in state.items()
+                           if key.startswith('normalizer_')])
+        if norm_state:
+            normalizer = _features.Normalizer.from_state(norm_state)
+        feature_specs = None
+        if 'feature_specs' in state:
+            feature_specs = [(name, tuple(args), kwargs) for 
+                             name, args, kwargs in 
+                             json.loads(str(state['feature_specs']))]
+        names = state.get('names')
+        if names is not None:
+            names = [str(n) for n in names]
+        threshold = state.get('threshold')
+        if threshold is not None:
+            threshold = float(threshold)
+        return cls(state['labels'], state['means'], state.get('covars'),
+                   names, threshold, normalizer, feature_specs,
+                   int(state['trash_label']))
+    
+    def save(self, fname):
+        """Save the model to a numpy `.npz` file"""
+        np.savez(fname, **self.get_state())
+        
+    @classmethod
+    def load(cls, fname):
+        """Load model saved with :py:meth:`save`"""
+        with np.load(fname) as state:
+            return cls.from_state(dict(state))
@@ -2,13 +2,65 @@
 #coding=utf-8
 
 import numpy as np
-from . import extract, cluster
+from scipy import spatial, special, ndimage
+from . import extract, cluster, features
 import warnings
 
 def deprecation(message):
     warnings.warn(message, DeprecationWarning, stacklevel=2)
 
-def snr_spike(spike_waves, scale=5.):
+def _wave_moments(sp_data, groups, n_groups, chunk_size=4096):
+    """Number of spikes, mean waveshape, sum of squared deviations from
+    the mean (per sample) and sum of peak-to-peak amplitudes (averaged
+    over contacts) of spikes in each group
+    
+    Spikes are read in chunks of `chunk_size` and the statistics of
+    chunks are combined with the parallel variant of Welford's 
+    algorithm (Chan et al.), so that no array of the size of waveforms
+    is created. Spikes with negative `groups` are skipped."""
+    n_pts, n_spikes = sp_data.shape[:2]
+    counts = np.zeros(n_groups)
+    means = None
+    for start in range(0, n_spikes, chunk_size):
+        stop = min(start + chunk_size, n_spikes)
+        chunk_groups = groups[start:stop]
+        selected = chunk_groups >= 0
+        chunk = np.asarray(sp_data[:, start:stop], dtype=np.float64)
+        chunk = chunk.reshape(n_pts, stop - start, -1)[:, selected]
+        chunk_groups = chunk_groups[selected]
+        x = chunk.transpose(1, 0, 2).reshape(len(chunk_groups), -1)
+        if means is None:
+            means = np.zeros((n_groups, x.shape[1]))
+            m2 = np.zeros((n_groups, x.shape[1]))
+            p2p = np.zeros(n_groups)
+        
+        sums, chunk_counts = cluster._cluster_sums(x, chunk_groups, n_groups)
+        chunk_means = sums/np.maximum(chunk_counts, 1)[:, np.newaxis]
+        residuals = x - chunk_means[chunk_groups]
+        residuals **= 2
+        chunk_m2, _ = cluster._cluster_sums(residuals, chunk_groups,
+                                            n_groups)
+        
+        total = np.maximum(counts + chunk_counts, 1)
+        delta = chunk_means - means
+        means += delta*(chunk_counts/total)[:, np.newaxis]
+        m2 += chunk_m2 + delta**2*(counts*chunk_counts/total)[:, np.newaxis]
+        counts += chunk_counts
+        
+        chunk_p2p = (chunk.max(0) - chunk.min(0)).mean(1)
+        p2p += np.bincount(chunk_groups, chunk_p2p, minlength=n_groups)
+    if means is None:
+        n_dims = np.prod(sp_data.shape[2:], dtype=int)*n_pts
+        means, m2 = np.zeros((n_groups, n_dims)), np.zeros((n_groups, n_dims))
+        p2p = np.zeros(n_groups)
+    return counts, means, m2, p2p
+
+def _snr_from_moments(counts, means, m2, scale):
+    peak_to_peak = means.max(1) - means.min(1)
+    noise_std = np.sqrt(m2.sum(1)/(counts*m2.shape[1]))
+    return peak_to_peak/(noise_std*scale)
+
+def snr_spike(spike_waves, scale=5., chunk_size=4096):
     """Estimate signal-to-noise ratio (SNR) as a ratio of
     peak-to-peak amplitude of an average spike to the std. deviation
     of residuals
@@ -16,6 +68,11 @@ def snr_spike(spike_waves, scale=5.):
     Parameters
     ----------
     spike_waves : dict
+    scale : float
+        scaling factor of the std. deviation of residuals
+    chunk_size : int
+        number of spikes processed at once (the waveforms are read only
+        once and residuals are not stored)
     
     Returns
     -------
@@ -24,19 +81,13 @@ def snr_spike(spike_waves, scale=5.):
     """
     
     sp_data = spike_waves['data']
-    avg_spike = sp_data.mean(1)
-
-    peak_to_peak = avg_spike.max()-avg_spike.min()
-
-    residuals = sp_data-avg_spike[:, np.newaxis]
-
-    noise_std = np.sqrt(residuals.var())
-
-    snr = peak_to_peak/(noise_std*scale)
+    groups = np.zeros(sp_data.shape[1], dtype=int)
+    counts, means, m2, _ = _wave_moments(sp_data, groups, 1, chunk_size)
+    snr, = _snr_from_moments(counts, means, m2, scale)
 
     return snr
 
-def snr_clust(spike_waves, noise_waves):
+def snr_clust(spike_waves, noise_waves, chunk_size=4096):
     """Calculate signal-to-noise ratio.
     
     Comparing average P2P amplitude of spike cluster to noise cluster
@@ -46,6 +97,8 @@ def snr_clust(spike_waves, noise_waves):
     ----------
     spike_waves : dict
     noise_waves : dict
+    chunk_size : int
+        number of spikes processed at once
     
     Returns
     -------
@@ -54,8 +107,9 @@ def snr_clust(spike_waves, noise_waves):
     """
 
     def _calc_p2p(data):
-        p2p = data.max(0)-data.min(0)
-        return p2p.mean()
+        groups = np.zeros(data.shape[1], dtype=int)
+        counts, _, _, p2p = _wave_moments(data, groups, 1, chunk_size)
+        return p2p[0]/counts[0]
 
     sp_data = spike_waves['data']
     avg_p2p_spk = _calc_p2p(sp_data)
@@ -67,6 +121,69 @@ def snr_clust(spike_waves, noise_waves):
 
     return snr
 
+def snr_scores(spike_waves, labels, noise_waves=None, scale=5., 
+               trash_label=0, chunk_size=4096):
+    """Calculate signal-to-noise ratios of all cells
+    
+    Waveforms are read only once, in chunks of spikes, and the 
+    statistics of all cells are accumulated together (see
+    :py:func:`snr_spike` and :py:func:`snr_clust`).
+    
+    Parameters
+    ----------
+    spike_waves : dict
+        waveforms of all spikes
+    labels : array
+        cell labels of spikes (for example, `labels` of 
+        :py:class:`spike_beans.components.ClusterAnalyzer`)
+    noise_waves : dict, optional
+        waveforms of noise events; if given, :py:func:`snr_clust` is 
+        calculated as well
+    scale : float
+        scaling factor of :py:func:`snr_spike`
+    trash_label : int
+        label of spikes which do not belong to any cell
+    chunk_size : int
+        number of spikes processed at once
+    
+    Returns
+    -------
+    scores : array
+        structured array with fields 'label', 'n_spikes', 'snr_spike' and 
+        'snr_clust' (NaN without `noise_waves`), one record for each 
+        cell
+    """
+    labels = np.asarray(labels)
+    mask = labels != trash_label
+    if 'is_valid' in spike_waves:
+        mask &= spike_waves['is_valid']
+    cell_ids, inv = np.unique(labels[mask], return_inverse=True)
+    groups = np.empty(len(labels), dtype=int)
+    groups.fill(-1)
+    groups[mask] = inv
+    
+    counts, means, m2, p2p = _wave_moments(spike_waves['data'], groups,
+                                           len(cell_ids), chunk_size)
+    
+    scores = np.zeros(len(cell_ids), dtype=[('label', labels.dtype),
+                                            ('n_spikes', int),
+                                            ('snr_spike', float),
+                                            ('snr_clust', float)])
+    scores['label'] = cell_ids
+    scores['n_spikes'] = counts
+    if not len(cell_ids):
+        return scores
+    scores['snr_spike'] = _snr_from_moments(counts, means, m2, scale)
+    if noise_waves is None:
+        scores['snr_clust'] = np.nan
+    else:
+        noise_data = noise_waves['data']
+        noise_groups = np.zeros(noise_data.shape[1], dtype=int)
+        n_noise, _, _, noise_p2p = _wave_moments(noise_data, noise_groups,
+                                                 1, chunk_size)
+        scores['snr_clust'] = (p2p/counts)/(noise_p2p[0]/n_noise[0])
+    return scores
+
 def extract_noise_cluster(sp, spt, sp_win, type="positive"):
 
 
@@ -88,11 +205,32 @@ def rand_sample_spt(spt, max_spikes):
 
 
 def detect_noise(sp, spt, sp_win, type="positive", max_spikes=None,
-        resample=1):
-    """Find noisy spikes"""
+        resample=1, method='detect'):
+    """Find noisy spikes
+    
+    Parameters
+    ----------
+    method : {'detect', 'random', 'peaks'}
+        'detect' finds threshold crossings in the whole recording and
+        selects `max_spikes` of them at random; 'random' and 'peaks'
+        draw `max_spikes` noise events directly with
+        :py:func:`sample_noise` (much faster for long recordings)
+    """
 
     spike_waves = extract.extract_spikes(sp, spt, sp_win)
-    
+    return _detect_noise(sp, spt, sp_win, spike_waves, type, max_spikes,
+                         resample, method)
+
+def _detect_noise(sp, spt, sp_win, spike_waves, type="positive", 
+                  max_spikes=None, resample=1, method='detect'):
+    if method != 'detect':
+        if not max_spikes:
+            raise ValueError("max_spikes must be given for method %s" %
+                             method)
+        threshold = calc_noise_threshold(spike_waves, 
+                                         1 if type == "positive" else -1)
+        return sample_noise(sp, spt, sp_win, max_spikes, type, method,
+                            threshold)
     if type == "positive":
         threshold = calc_noise_threshold(spike_waves, 1)
         spt_noise = extract.detect_spikes(sp, threshold, 'rising')
@@ -111,6 +249,107 @@ def detect_noise(sp, spt, sp_win, type="positive", max_spikes=None,
 
     return spt_noise
 
+def sample_noise(sp, spt, sp_win, n_events, type="positive", 
+                 method='peaks', threshold=None, contact=0, seed=None,
+                 max_rounds=100):
+    """Draw a random sample of noise events
+    
+    Unlike :py:func:`detect_noise`, the recording is not scanned for
+    threshold crossings. Candidate positions are drawn at random and
+    only the signal around them is read, so the cost is proportional to
+    `n_events` and not to the length of the recording. Candidates
+    within `sp_win` of any spike of `spt` are rejected (spike times are
+    sorted once and looked up with binary search) and drawing is
+    repeated until `n_events` events are found.
+    
+    Parameters
+    ----------
+    sp : dict
+        raw recording
+    spt : dict
+        spike times of the (sorted) spikes to exclude
+    sp_win : list or tuple
+        window used for spike extraction
+    n_events : int
+        number of noise events
+    type : {'positive', 'negative'}
+        polarity of spikes
+    method : {'peaks', 'random'}
+        'peaks' returns local extrema (maxima for positive and minima
+        for negative spikes) exceeding `threshold`, which are searched 
+        for in a window of `sp_win` width around each random position;
+        'random' returns the random positions themselves
+    threshold : float, optional
+        threshold of noise events for method 'peaks'; by default it is
+        calculated from the spikes with :py:func:`calc_noise_threshold`
+    contact : int
+        contact on which the extrema are searched for
+    seed : None, int or RandomState
+        random generator (or its seed)
+    max_rounds : int
+        maximum number of drawing rounds; if fewer than `n_events`
+        events are found, a warning is issued and the events found so
+        far are returned
+    
+    Returns
+    -------
+    spt_noise : dict
+        sorted spike times of noise events
+    """
+    if method not in ('peaks', 'random'):
+        raise ValueError("unknown sampling method %s" % method)
+    gain = 1 if type == "positive" else -1
+    FS = sp['FS']
+    n_pts = sp['data'].shape[1]
+    rng = cluster._check_random_state(seed)
+    
+    if method == 'peaks' and threshold is None:
+        spike_waves = extract.extract_spikes(sp, spt, sp_win)
+        threshold = calc_noise_threshold(spike_waves, gain)
+    
+    #all positions are handled as sample indices
+    ms2pts = FS/1000.
+    i_min = int(np.ceil(max(-sp_win[0], 0)*ms2pts))
+    i_max = int(np.floor(n_pts - max(sp_win[1], 0)*ms2pts)) - 1
+    if i_max < i_min:
+        return {'data': np.zeros(0)}
+    half_win = (sp_win[1] - sp_win[0])/2.
+    spike_times = np.sort(spt['data'])
+    
+    events = np.zeros(0, dtype=np.int64)
+    for n_round in range(max_rounds):
+        n_missing = n_events - len(events)
+        if n_missing <= 0:
+            break
+        idx = rng.randint(i_min, i_max + 1, size=2*n_missing + 16)
+        if method == 'peaks':
+            search_win = [-half_win, half_win]
+            spt_search = idx/ms2pts
+            waves = extract.extract_spikes(sp, {'data': spt_search},
+                                           search_win, contacts=contact)
+            #first samples of the windows as computed by extract_spikes
+            idx = ((spt_search/1000.*FS).astype(np.int32) + 
+                   int(search_win[0]/1000.*FS))
+            trace = gain*waves['data'][:, :, 0]
+            i_peak = trace.argmax(0)
+            is_peak = ((i_peak > 0) & (i_peak < trace.shape[0] - 1) &
+                       (trace[i_peak, np.arange(len(idx))] >= 
+                        gain*threshold))
+            if 'is_valid' in waves:
+                is_peak &= waves['is_valid']
+            idx = (idx + i_peak)[is_peak]
+            idx = idx[(idx >= i_min) & (idx <= i_max)]
+        idx = idx[~extract._window_overlap(idx/ms2pts, spike_times, 
+                                           sp_win)]
+        events = np.union1d(events, idx)
+    
+    if len(events) > n_events:
+        events = np.sort(rng.permutation(events)[:n_events])
+    elif len(events) < n_events:
+        warnings.warn("only %d noise events found" % len(events))
+    
+    return {'data': events/ms2pts}
+
 def calc_noise_threshold(spike_waves, sign=1, frac_spikes=0.02, frac_max=0.5):
     """ Find threshold to extract noise cluster.
     
@@ -203,10 +442,49 @@ def _iso_score_dist(dist, lam, n_spikes):
 
 
 
+def _iso_score_blocks(spike_data, noise_data, lam, max_memory=2**26,
+                      spike_norms=None, noise_norms=None):
+    """Calculate isolation score from (n_spikes, n_dims) and 
+    (n_noise, n_dims) arrays of waveforms in blocks of distances
+    
+    The first pass over spike-spike distances finds their mean `d0`, the
+    second accumulates the sums of exp(-d*lam/d0) over spikes and noise
+    events, so that only one block of distances is kept in memory at a
+    time.
+    """
+    n_spikes = spike_data.shape[0]
+    kwargs = dict(max_memory=max_memory, norms1=spike_norms)
+    
+    d_sum = 0.
+    for _, _, block in cluster.iter_metric_euclidean(spike_data, **kwargs):
+        d_sum += block.sum()
+    d0 = d_sum/n_spikes**2
+    
+    sumSS = np.empty(n_spikes)
+    sumSN = np.zeros(n_spikes)
+    for start, stop, block in cluster.iter_metric_euclidean(spike_data,
+                                                            **kwargs):
+        block *= -lam*1./d0
+        np.exp(block, block)
+        sumSS[start:stop] = block.sum(1) - 1
+    if len(noise_data):
+        for start, stop, block in cluster.iter_metric_euclidean(spike_data,
+                                    noise_data, norms2=noise_norms, 
+                                    **kwargs):
+            block *= -lam*1./d0
+            np.exp(block, block)
+            sumSN[start:stop] = block.sum(1)
+
+    correctProbS = sumSS / (sumSS + sumSN)
+    return correctProbS.mean()
+
 def calc_isolation_score(spike_waves, noise_waves, spike_type='positive',
-        lam=10., max_spikes=None):
+        lam=10., max_spikes=None, max_memory=2**26):
     """Calculate isolation index according to Joshua et al. (2007)
     
+    Distances between waveforms are calculated in blocks, so the memory
+    used does not depend on the number of spikes.
+    
     Parameters
     ----------
     spike_waves : dict
@@ -218,6 +496,11 @@ def calc_isolation_score(spike_waves, noise_waves, spike_type='positive',
         positive or negative going
     lambda : float
         determines the "softness" of clusters 
+    max_spikes : int, optional
+        if given, at most `max_spikes` randomly selected spikes and 
+        noise events are used (this is no longer needed to save memory)
+    max_memory : int, optional
+        maximum size (in bytes) of a block of distances
       
     Returns
     -------
@@ -226,28 +509,510 @@ def calc_isolation_score(spike_waves, noise_waves, spike_type='positive',
         (1=ideal isolation of spikes)
     """
 
-    #Memory issue: sample spikes if too many
     if max_spikes is not None:
         if spike_waves['data'].shape[1]>max_spikes:
-           i = np.random.rand(max_spikes).argsort()
+           n = spike_waves['data'].shape[1]
+           i = np.random.rand(n).argsort()[:max_spikes]
            spike_waves = spike_waves.copy()
            spike_waves['data'] = spike_waves['data'][:, i]
         if noise_waves['data'].shape[1]>max_spikes:
-           i = np.random.rand(max_spikes).argsort()
+           n = noise_waves['data'].shape[1]
+           i = np.random.rand(n).argsort()[:max_spikes]
            noise_waves = noise_waves.copy()
            noise_waves['data'] = noise_waves['data'][:, i]
 
-
-    n_spikes = spike_waves['data'].shape[1]
-    
-    #calculate distance between spikes and all other events
-    all_waves = {'data': np.concatenate((spike_waves['data'],
-                                    noise_waves['data']),1)}
-    dist_matrix = cluster.dist_euclidean(spike_waves, all_waves)
-    #d_0 = dist_matrix[:,:n_spikes].mean()
+    spike_data = cluster._waves2vectors(spike_waves)
+    noise_data = cluster._waves2vectors(noise_waves)
    
-    isolation_score = _iso_score_dist(dist_matrix, lam,
-            n_spikes)
+    isolation_score = _iso_score_blocks(spike_data, noise_data, lam, 
+                                        max_memory)
 
     return isolation_score
 
+def _mean_distance(data, n_samples=None, seed=None, max_memory=2**26):
+    """Mean Euclidean distance between all pairs of rows (including
+    pairs of identical rows) estimated from `n_samples` random pairs or
+    calculated exactly if `n_samples` is None"""
+    n = len(data)
+    if n_samples is None or n_samples >= n**2:
+        d_sum = 0.
+        for _, _, block in cluster.iter_metric_euclidean(data, 
+                                                    max_memory=max_memory):
+            d_sum += block.sum()
+        return d_sum/n**2
+    rng = cluster._check_random_state(seed)
+    i = rng.randint(n, size=n_samples)
+    j = rng.randint(n, size=n_samples)
+    return np.sqrt(((data[i] - data[j])**2).sum(1)).mean()
+
+def _kernel_sums(tree, data, radius, scale, max_memory=2**26):
+    """Sums of exp(-d*scale) over points of `tree` within `radius` of 
+    each row of `data` and numbers of these points
+    
+    Neighbours are searched for blocks of rows of `data`. The number of
+    rows in a block is adapted to the number of neighbours found in the
+    previous block, so that the pairs of a block (and their distances)
+    take approximately at most `max_memory` bytes."""
+    sums = np.zeros(len(data))
+    counts = np.zeros(len(data), dtype=int)
+    #index pair and distance of a neighbour (24 bytes) are stored in
+    #the internal list of the tree and copied once to the returned array,
+    #and bincount copies their row indices and weights (16 bytes), so
+    #each pair takes 64 bytes
+    max_pairs = max(max_memory//64, 1)
+    start, n_rows = 0, 64
+    while start < len(data):
+        block = data[start:start+n_rows]
+        n_block = len(block)
+        pairs = spatial.cKDTree(block).sparse_distance_matrix(
+                                    tree, radius, output_type='ndarray')
+        weights = pairs['v']
+        weights *= -scale
+        np.exp(weights, weights)
+        sums[start:start+n_block] = np.bincount(pairs['i'], weights, 
+                                                minlength=n_block)
+        counts[start:start+n_block] = np.bincount(pairs['i'], 
+                                                  minlength=n_block)
+        start += n_block
+        pairs_per_row = len(pairs)*1./n_block
+        n_rows = int(min(max(max_pairs/max(pairs_per_row, 1.), 1), 65536))
+    return sums, counts
+
+def _iter_distances(data, others, exclude=None, max_memory=2**26):
+    """Blocks of distances between rows of `data` and all rows of
+    `others`; the distance of row i of `data` to row `exclude[i]` of
+    `others` is set to infinity"""
+    for start, stop, block in cluster.iter_metric_euclidean(data, others,
+                                                max_memory=max_memory):
+        if exclude is not None:
+            block[np.arange(stop-start), exclude[start:stop]] = np.inf
+        yield start, stop, block
+
+def _exact_probs(spike_data, noise_data, idx, scale, max_memory=2**26):
+    """Probabilities that spikes `idx` are closer to the other spikes
+    than to noise, summed over all pairs
+    
+    The terms are divided by the term of the nearest event, so that
+    they do not underflow for spikes far from all other events."""
+    rows = spike_data[idx]
+    nearest = np.empty(len(idx))
+    nearest.fill(np.inf)
+    for others, exclude in [(spike_data, idx), (noise_data, None)]:
+        if len(others):
+            for start, stop, block in _iter_distances(rows, others, 
+                                                      exclude, max_memory):
+                nearest[start:stop] = np.minimum(nearest[start:stop],
+                                                 block.min(1))
+    sums = []
+    for others, exclude in [(spike_data, idx), (noise_data, None)]:
+        block_sums = np.zeros(len(idx))
+        if len(others):
+            for start, stop, block in _iter_distances(rows, others, 
+                                                      exclude, max_memory):
+                block -= nearest[start:stop, np.newaxis]
+                block *= -scale
+                np.exp(block, block)
+                block_sums[start:stop] = block.sum(1)
+        sums.append(block_sums)
+    sumSS, sumSN = sums
+    return sumSS/(sumSS + sumSN)
+
+def calc_isolation_score_approx(spike_waves, noise_waves, lam=10., 
+                                cutoff=5., tol=0.01, n_components=None, 
+                                d0_samples=100000, max_memory=2**26,
+                                seed=None):
+    """Calculate approximate isolation index 
+    
+    The terms exp(-d*lam/d0) of the isolation score (see
+    :py:func:`calc_isolation_score`) are summed only over pairs of 
+    events closer than `cutoff`*d0/lam, which are found with KD-trees,
+    i.e. each neglected term is smaller than exp(-`cutoff`). Spikes for
+    which the neglected terms could change the probability of being
+    closer to the other spikes than to noise by more than `tol` (in
+    particular spikes without any neighbour within the cutoff) are
+    scored exactly over all pairs. The running time grows with the
+    number of close pairs and of the spikes scored exactly rather than
+    with the number of all pairs, so the calculation is much faster
+    than the exact one for large clusters.
+    
+    KD-trees are efficient only in low dimensions; in many dimensions
+    the distances between spikes also concentrate around `d0`, so that
+    few pairs are close and most spikes are scored exactly. Projection
+    on principal components (`n_components`) makes the calculation
+    faster, but the score is then calculated for the projected
+    waveforms and can differ from the score of the full waveforms by
+    much more than `error`.
+    
+    Parameters
+    ----------
+    spike_waves : dict
+    noise_waves : dict
+    lam : float
+        determines the "softness" of clusters 
+    cutoff : float
+        pairs farther than `cutoff`*d0/lam are searched for only for
+        spikes scored exactly
+    tol : float
+        maximum error of the score of a single spike caused by the
+        neglected pairs
+    n_components : int or None
+        number of principal components (of spikes and noise) on which
+        the waveforms are projected; None uses the waveforms
+    d0_samples : int or None
+        number of random pairs of spikes used to estimate `d0` (None 
+        calculates the exact mean distance)
+    max_memory : int, optional
+        approximate maximum size (in bytes) of the pairs of neighbours
+        or of the blocks of distances processed at once
+    seed : None, int or RandomState
+        random generator (or its seed) used for sampling pairs
+    
+    Returns
+    -------
+    isolation_score : float
+        approximate isolation score
+    error : float
+        upper bound (at most `tol`) of the error of the score caused by
+        the neglected pairs; it holds for the `d0` and waveforms used,
+        so with `d0_samples` and `n_components` set to None the exact
+        score differs from `isolation_score` by at most `error` (up to
+        round-off errors)
+    """
+    spike_data = cluster._waves2vectors(spike_waves).astype(np.float64)
+    noise_data = cluster._waves2vectors(noise_waves).astype(np.float64)
+    if n_components is not None and n_components < spike_data.shape[1]:
+        all_data = np.vstack((spike_data, noise_data))
+        _, evecs, _ = features.PCA(all_data.T, n_components)
+        components = evecs[:, :n_components]
+        spike_data = np.dot(spike_data, components)
+        noise_data = np.dot(noise_data, components)
+    n_spikes, n_noise = len(spike_data), len(noise_data)
+    
+    d0 = _mean_distance(spike_data, d0_samples, seed)
+    scale = lam*1./d0
+    radius = cutoff/scale
+    
+    spike_tree = spatial.cKDTree(spike_data)
+    sumSS, countSS = _kernel_sums(spike_tree, spike_data, radius, scale, 
+                                  max_memory)
+    #remove the distance of each spike to itself
+    sumSS -= 1
+    countSS -= 1
+    #neglected events are farther than the radius and than the nearest
+    #event, so each neglected term is smaller than termSS (termSN)
+    nearestSS = np.inf
+    if n_spikes > 1:
+        nearestSS = spike_tree.query(spike_data, 2)[0][:, 1]
+    termSS = np.exp(-scale*np.maximum(radius, nearestSS))
+    sumSN = np.zeros(n_spikes)
+    countSN = np.zeros(n_spikes, dtype=int)
+    termSN = 0.
+    if n_noise:
+        noise_tree = spatial.cKDTree(noise_data)
+        sumSN, countSN = _kernel_sums(noise_tree, spike_data, radius, 
+                                      scale, max_memory)
+        nearestSN = noise_tree.query(spike_data, 1)[0]
+        termSN = np.exp(-scale*np.maximum(radius, nearestSN))
+    
+    #the neglected parts of sumSS and sumSN are at most errSS and errSN,
+    #so the error of sumSS/(sumSS+sumSN) is at most 
+    #max(errSS*sumSN, errSN*sumSS)/total**2
+    errSS = termSS*(n_spikes - 1 - countSS)
+    errSN = termSN*(n_noise - countSN)
+    total = sumSS + sumSN
+    found = total > 0
+    correctProbS = np.zeros(n_spikes)
+    errors = np.ones(n_spikes)
+    correctProbS[found] = sumSS[found]/total[found]
+    errors[found] = (np.maximum(errSS*sumSN, errSN*sumSS)[found]/
+                     total[found]**2)
+    
+    inexact = np.nonzero(errors > tol)[0]
+    if len(inexact):
+        correctProbS[inexact] = _exact_probs(spike_data, noise_data, 
+                                             inexact, scale, max_memory)
+        errors[inexact] = 0.
+    return correctProbS.mean(), errors.mean()
+
+def isolation_scores(sp, spt, labels, sp_win, spike_type='positive', 
+                     lam=10., max_noise=None, trash_label=0, 
+                     max_memory=2**26, resample=1, noise_method='detect'):
+    """Calculate isolation scores of all cells of a recording session
+    
+    The scores approximate those of :py:func:`isolation_score` called
+    for each cell, but the raw signal is scanned only once: waveforms
+    of all spikes are extracted together and a single, shared set of
+    noise events is detected (and aligned) with the lowest of the
+    thresholds of all cells. The noise set of each cell is then
+    selected from this shared set (events whose peak on the detection
+    contact exceeds the threshold of the cell and which do not overlap
+    its spikes). Because the shared events are aligned before the
+    exclusion of spikes and detected at a lower threshold, the noise
+    sets differ slightly from those of the per-cell calculation. Norms
+    of all waveforms are calculated once and reused by the distance
+    calculations.
+    
+    Parameters
+    ----------
+    sp : dict
+        raw recording
+    spt : dict
+        spike times of all spikes
+    labels : array
+        cell labels of spikes (for example, `labels` of 
+        :py:class:`spike_beans.components.ClusterAnalyzer`)
+    sp_win : list or tuple
+        window used for spike extraction
+    spike_type : {'positive', 'negative'}
+        indicates if the spikes are positive or negative going
+    lam : float
+        determines the "softness" of clusters 
+    max_noise : int, optional
+        maximum number of (randomly selected) noise events
+    trash_label : int
+        label of spikes which do not belong to any cell
+    max_memory : int, optional
+        maximum size (in bytes) of a block of distances
+    noise_method : {'detect', 'peaks', 'random'}
+        'detect' detects noise events in the whole recording, 'peaks'
+        and 'random' draw `max_noise` events with
+        :py:func:`sample_noise` (for 'random' the noise events are not
+        required to exceed the thresholds of cells)
+    
+    Returns
+    -------
+    scores : array
+        structured array with fields 'label', 'n_spikes', 'n_noise' and
+        'isolation_score', one record for each cell
+    """
+    labels = np.asarray(labels)
+    gain = 1 if spike_type == 'positive' else -1
+    spike_waves = extract.extract_spikes(sp, spt, sp_win)
+    sorted_mask = labels != trash_label
+    if 'is_valid' in spike_waves:
+        sorted_mask &= spike_waves['is_valid']
+    cell_ids = np.unique(labels[sorted_mask])
+    
+    spike_data = cluster._waves2vectors(spike_waves)
+    spike_norms = cluster._row_norms(spike_data.astype(np.float64))
+    cell_idx = [np.nonzero(sorted_mask & (labels == cell))[0] 
+                for cell in cell_ids]
+    thresholds = np.array([calc_noise_threshold(
+                                {'data': spike_waves['data'][:, idx]}, gain)
+                           for idx in cell_idx])
+    
+    scores = np.zeros(len(cell_ids), dtype=[('label', int), 
+                                            ('n_spikes', int),
+                                            ('n_noise', int),
+                                            ('isolation_score', float)])
+    scores['label'] = cell_ids
+    scores['n_spikes'] = [len(idx) for idx in cell_idx]
+    if not len(cell_ids):
+        return scores
+    
+    threshold = gain*np.min(gain*thresholds)
+    edge, align_type = (('rising', 'max') if gain > 0 else 
+                        ('falling', 'min'))
+    if noise_method == 'detect':
+        spt_noise = extract.detect_spikes(sp, threshold, edge)
+        spt_noise = rand_sample_spt(spt_noise, max_noise)
+        spt_noise = extract.align_spikes(sp, spt_noise, sp_win, align_type,
+                                         resample=resample)
+    elif not max_noise:
+        raise ValueError("max_noise must be given for noise_method %s" %
+                         noise_method)
+    else:
+        #spikes of all cells are excluded here, so that the per-cell
+        #exclusion below removes nothing more
+        spt_noise = sample_noise(sp, spt, sp_win, max_noise, spike_type,
+                                 noise_method, threshold)
+    noise_waves = extract.extract_spikes(sp, spt_noise, sp_win)
+    noise_data = cluster._waves2vectors(noise_waves)
+    noise_norms = cluster._row_norms(noise_data.astype(np.float64))
+    #noise events are detected on the first contact
+    noise_peak = (gain*noise_waves['data'][:, :, 0]).max(0)
+    
+    for i, idx in enumerate(cell_idx):
+        if noise_method == 'random':
+            noise_mask = np.ones(len(noise_peak), dtype=bool)
+        else:
+            noise_mask = noise_peak >= gain*thresholds[i]
+        noise_mask &= ~extract._window_overlap(spt_noise['data'], 
+                                               spt['data'][idx], sp_win)
+        scores['n_noise'][i] = noise_mask.sum()
+        scores['isolation_score'][i] = _iso_score_blocks(
+                                spike_data[idx], noise_data[noise_mask], 
+                                lam, max_memory, spike_norms[idx],
+                                noise_norms[noise_mask])
+    return scores
+
+def _amplitude_cutoff(amplitudes, n_bins=500, smoothing=3):
+    """Estimate fraction of spikes missing below the detection
+    threshold from the (smoothed) histogram of spike amplitudes"""
+    if len(amplitudes) < 2:
+        return np.nan
+    pdf, support = np.histogram(amplitudes, n_bins, density=True)
+    pdf = ndimage.gaussian_filter1d(pdf, smoothing)
+    i_peak = pdf.argmax()
+    #mirror the lower tail of the distribution on the upper one
+    i_cut = np.abs(pdf[i_peak:] - pdf[0]).argmin() + i_peak
+    fraction_missing = pdf[i_cut:].sum()*np.diff(support).mean()
+    return min(fraction_missing, 0.5)
+
+def quality_metrics(spt, labels, feature_data=None, amplitudes=None, 
+                    trash_label=0, isi_threshold=1.5, min_isi=0., 
+                    t_range=None, presence_bins=100, amp_bins=500, 
+                    amp_smoothing=3, reg_covar=1e-6):
+    """Calculate quality metrics of all cells of a recording session
+    
+    The metrics are:
+    
+    * ISI violations -- rate of refractory period violations relative to
+      the firing rate, which estimates the fraction of spikes coming
+      from other neurons (Hill et al., 2011),
+    * L-ratio -- sum of the probabilities (chi-square distributed
+      squared Mahalanobis distances) that the spikes of other clusters
+      belong to the cell divided by the number of spikes of the cell
+      (Schmitzer-Torbert et al., 2005),
+    * isolation distance -- squared Mahalanobis distance of the n-th
+      closest spike of other clusters, where n is the number of spikes 
+      of the cell (Harris et al., 2001),
+    * presence ratio -- fraction of time bins of the recording in which
+      the cell fired,
+    * amplitude cutoff -- estimated fraction of spikes missed because
+      their amplitudes were below the detection threshold.
+    
+    Spike times are sorted only once (grouped by cells) and the
+    covariance matrix of each cell is inverted once; the Mahalanobis
+    distances of all spikes to all cells are calculated together (see
+    :py:class:`spike_sort.core.cluster.ClusterModel`).
+    
+    Parameters
+    ----------
+    spt : dict
+        spike times of all spikes
+    labels : array
+        cell labels of spikes (for example, `labels` of 
+        :py:class:`spike_beans.components.ClusterAnalyzer`)
+    feature_data : dict, optional
+        features of the spikes; required for L-ratio and isolation
+        distance
+    amplitudes : array, optional
+        amplitudes of the spikes (for example, peak-to-peak amplitudes
+        on the contact with the largest spikes); required for amplitude
+        cutoff
+    trash_label : int
+        label of spikes which do not belong to any cell (they are used
+        as spikes of other clusters in L-ratio and isolation distance)
+    isi_threshold : float
+        refractory period (in ms)
+    min_isi : float
+        minimum possible inter-spike interval (in ms), for example the
+        dead time of spike detection
+    t_range : tuple, optional
+        start and end time (in ms) of the recording; defaults to the 
+        times of the first and last spike
+    presence_bins : int
+        number of time bins used for presence ratio
+    amp_bins, amp_smoothing : int
+        number of bins and width (in bins) of the gaussian smoothing
+        of the amplitude histogram
+    reg_covar : float
+        regularization of covariances relative to the average feature
+        variance
+    
+    Returns
+    -------
+    metrics : array
+        structured array with fields 'label', 'n_spikes',
+        'n_isi_violations', 'isi_violations', 'presence_ratio',
+        'l_ratio', 'isolation_distance' and 'amplitude_cutoff', one
+        record for each cell; metrics which can not be calculated are
+        NaN
+    """
+    spt_data = np.asarray(spt['data'], dtype=np.float64)
+    labels = np.asarray(labels)
+    cell_mask = labels != trash_label
+    cell_ids, inv = np.unique(labels[cell_mask], return_inverse=True)
+    n_cells = len(cell_ids)
+    
+    metrics = np.zeros(n_cells, dtype=[('label', labels.dtype), 
+                                       ('n_spikes', int),
+                                       ('n_isi_violations', int),
+                                       ('isi_violations', float),
+                                       ('presence_ratio', float),
+                                       ('l_ratio', float),
+                                       ('isolation_distance', float),
+                                       ('amplitude_cutoff', float)])
+    metrics['label'] = cell_ids
+    if n_cells == 0:
+        return metrics
+    
+    times = spt_data[cell_mask]
+    if t_range is None:
+        t_range = (spt_data.min(), spt_data.max())
+    t_start, t_end = t_range
+    duration = t_end - t_start
+    
+    #spike times sorted within cells
+    order = np.lexsort((times, inv))
+    times, inv = times[order], inv[order]
+    counts = np.bincount(inv, minlength=n_cells)
+    metrics['n_spikes'] = counts
+    
+    isi = np.diff(times)
+    violations = (inv[1:] == inv[:-1]) & (isi < isi_threshold)
+    n_violations = np.bincount(inv[1:][violations], minlength=n_cells)
+    metrics['n_isi_violations'] = n_violations
+    if duration > 0 and isi_threshold > min_isi:
+        violation_time = 2*counts*(isi_threshold - min_isi)
+        total_rate = counts*1./duration
+        metrics['isi_violations'] = n_violations/violation_time/total_rate
+    else:
+        metrics['isi_violations'] = np.nan
+    
+    in_range = (times >= t_start) & (times <= t_end)
+    if duration > 0:
+        bins = ((times[in_range] - t_start)/duration*presence_bins
+                ).astype(int)
+        np.minimum(bins, presence_bins - 1, bins)
+    else:
+        bins = np.zeros(in_range.sum(), dtype=int)
+    occupied = np.unique(inv[in_range]*presence_bins + bins)
+    metrics['presence_ratio'] = np.bincount(occupied//presence_bins, 
+                                            minlength=n_cells
+                                            )*1./presence_bins
+    
+    metrics['l_ratio'] = np.nan
+    metrics['isolation_distance'] = np.nan
+    if feature_data is not None:
+        model = cluster.ClusterModel.from_labels(feature_data, labels,
+                                                 trash_label, alpha=None,
+                                                 reg_covar=reg_covar)
+        valid = np.ones(len(labels), dtype=bool)
+        if feature_data.get('is_valid') is not None:
+            valid = np.asarray(feature_data['is_valid'], dtype=bool)
+        dist = model.distances(feature_data)[valid]
+        valid_labels = labels[valid]
+        n_features = model.means.shape[1]
+        for k, cell in enumerate(model.labels):
+            i, = np.nonzero(cell_ids == cell)
+            other = dist[valid_labels != cell, k]
+            n_cell = len(dist) - len(other)
+            if n_cell == 0:
+                continue
+            metrics['l_ratio'][i] = (special.chdtrc(n_features, other).sum()
+                                     /n_cell)
+            if n_cell <= len(other):
+                metrics['isolation_distance'][i] = np.partition(
+                                                other, n_cell-1)[n_cell-1]
+    
+    metrics['amplitude_cutoff'] = np.nan
+    if amplitudes is not None:
+        amplitudes = np.asarray(amplitudes)[cell_mask][order]
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        for k in range(n_cells):
+            metrics['amplitude_cutoff'][k] = _amplitude_cutoff(
+                                        amplitudes[bounds[k]:bounds[k+1]],
+                                        amp_bins, amp_smoothing)
+    return metrics
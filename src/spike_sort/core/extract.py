@@ -149,16 +149,27 @@ def split_cells(spikes, idx, which='all'):
 
     return spikes_dict
 
+def _window_overlap(event_times, spike_times, sp_win):
+    """Return mask of events occuring within `sp_win` window of any of
+    `spike_times`"""
+    spike_times = np.sort(spike_times)
+    lo = np.searchsorted(spike_times, event_times - sp_win[1], 'left')
+    hi = np.searchsorted(spike_times, event_times - sp_win[0], 'right')
+    return hi > lo
+
 def remove_spikes(spt_dict, remove_dict, tolerance):
     """Remove spikes with given spike times from the spike time
-    structure """
-    spt_data = spt_dict['data']
-    spt_remove = remove_dict['data']
-
-    min, max = tolerance
+    structure 
+    
+    A spike at time t is removed if it falls within the window 
+    [t_r+tolerance[0], t_r+tolerance[1]] of any of the spike times t_r
+    in `remove_dict`. The spike times to remove are sorted and looked
+    up with binary search, so the cost grows as N*log(M) rather than
+    N*M."""
+    spt_data = np.asarray(spt_dict['data'])
+    spt_remove = np.asarray(remove_dict['data'])
 
-    for t in spt_remove:
-        spt_data = spt_data[(spt_data>(t+max)) | (spt_data<(t+min))]
+    spt_data = spt_data[~_window_overlap(spt_data, spt_remove, tolerance)]
 
     spt_ret = spt_dict.copy()
 
@@ -15,8 +15,8 @@ Each of the function returns a (mapping) object with following keys:
 
 
 import numpy as np
-import matplotlib.pyplot as plt
-from functools import reduce
+from scipy import special
+from concurrent import futures
 
 def split_cells(features, idx, which='all'):
     """return the spike features splitted into separate cells"""
@@ -34,23 +34,92 @@ def split_cells(features, idx, which='all'):
     return feature_dict
 
 
-def select(features_dict, features_ids):
-    """Choose selected features from the collection"""
+class FeatureTable(dict):
+    """Features structure with an index of feature names.
     
-    def _feat2idx(id):
-        if type(id) is str:
-            i = np.nonzero(names==id)[0][0]
-            return i
-        else:
-            return id
-   
-    names = features_dict['names']
-    features = features_dict['data']
-    ii = np.array([_feat2idx(id) for id in features_ids])
-
-    selected = {"data": features[:,ii], "names": names[ii]}
+    It is a dictionary with the same keys as the features structure
+    (`data`, `names` and optionally `is_valid`), so it can be used
+    wherever features are expected. In addition, columns can be looked
+    up by their names in constant time.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._index = None
+        
+    def __setitem__(self, key, value):
+        if key == 'names':
+            self._index = None
+        dict.__setitem__(self, key, value)
+    
+    def copy(self):
+        return FeatureTable(self)
+    
+    @property
+    def index(self):
+        """dictionary mapping feature names to column indices"""
+        if self._index is None:
+            self._index = dict((str(name), i) 
+                               for i, name in enumerate(self['names']))
+        return self._index
+    
+    def columns(self, features_ids):
+        """Return column indices of features given by names or indices"""
+        index = self.index
+        ii = []
+        for id in features_ids:
+            if isinstance(id, str):
+                try:
+                    ii.append(index[id])
+                except KeyError:
+                    raise KeyError("feature %s does not exist" % id)
+            else:
+                ii.append(int(id))
+        return np.array(ii, dtype=int)
+    
+    def column(self, feature_id):
+        """Return a single feature (a view on the data)"""
+        i = self.columns([feature_id])[0]
+        return self['data'][:, i]
+    
+    def select(self, features_ids):
+        """Choose features given by names or indices. 
+        
+        If the columns are equally spaced (for example, contiguous) the
+        returned data is a view on the original data. Otherwise, it is a
+        copy."""
+        ii = self.columns(features_ids)
+        step = np.diff(ii)
+        if (ii >= 0).all() and (len(ii) == 1 or 
+                                (len(ii) > 1 and step[0] > 0 and 
+                                 (step == step[0]).all())):
+            step = step[0] if len(ii) > 1 else 1
+            ii = slice(ii[0], ii[-1] + 1, step)
+        
+        selected = FeatureTable(self)
+        selected['data'] = self['data'][:, ii]
+        selected['names'] = np.asarray(self['names'])[ii]
+        return selected
 
-    return selected
+def select(features_dict, features_ids):
+    """Choose selected features from the collection
+    
+    Parameters
+    ----------
+    features_dict : dict
+        features structure
+    features_ids : list
+        list of feature names or column indices
+        
+    Returns
+    -------
+    selected : FeatureTable
+        features structure with selected features only
+    """
+    
+    if not isinstance(features_dict, FeatureTable):
+        features_dict = FeatureTable(features_dict)
+    return features_dict.select(features_ids)
 
 def select_spikes(features, idx):
     """Truncate features array to selected spikes. This method should be
@@ -76,43 +145,241 @@ def select_spikes(features, idx):
         new_feats['is_valid'] = features['is_valid'][idx]
     return new_feats
 
-def combine(args, norm=True):
+class FeatureMatrix(object):
+    """Feature matrix preallocated for a given number of columns.
+    
+    Columns of the features added with :py:meth:`add` are written
+    directly to the matrix (without any intermediate copies). The matrix
+    can be then normalized in place.
+    
+    Parameters
+    ----------
+    n_spikes : int
+        number of spikes (rows)
+    n_features : int
+        total number of features (columns)
+    dtype : dtype, optional
+        data type of the matrix (float32 by default)
+    
+    Attributes
+    ----------
+    data : array
+        (n_spikes, n_features) matrix
+    names : list
+        labels of the features added so far
+    ranges : dict
+        column ranges `(start, stop)` of each added feature structure
+    """
+    
+    def __init__(self, n_spikes, n_features, dtype=np.float32):
+        self.data = np.empty((n_spikes, n_features), dtype=dtype)
+        self.clear()
+    
+    def clear(self):
+        """Remove all features (the memory is reused)"""
+        self.names = []
+        self.ranges = {}
+        self.mask = None
+        self._n_cols = 0
+        
+    def add(self, feature_dict, name=None):
+        """Copy the columns of a feature structure to the matrix
+        
+        Parameters
+        ----------
+        feature_dict : dict
+            features structure
+        name : str, optional
+            key under which the column range of the feature is stored
+            in `ranges`; defaults to the position of the feature
+        """
+        
+        block = feature_dict['data']
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        n_spikes, n_cols = block.shape
+        start, stop = self._n_cols, self._n_cols + n_cols
+        if n_spikes != self.data.shape[0]:
+            raise ValueError('all features must contain the same number of'
+                             ' spikes')
+        if stop > self.data.shape[1]:
+            raise ValueError('too many features for the allocated matrix')
+        
+        self.data[:, start:stop] = block
+        self.names.extend(feature_dict['names'])
+        if name is None:
+            name = len(self.ranges)
+        self.ranges[name] = (start, stop)
+        self._n_cols = stop
+        
+        if 'is_valid' in feature_dict:
+            if self.mask is None:
+                self.mask = np.array(feature_dict['is_valid'], dtype=bool)
+            else:
+                self.mask &= feature_dict['is_valid']
+    
+    def normalize(self):
+        """Normalize the features in place"""
+        _normalize_data(self.data[:, :self._n_cols])
+        
+    def to_dict(self):
+        """Return a features structure sharing memory with the matrix"""
+        features = FeatureTable(data=self.data[:, :self._n_cols], 
+                                names=np.array(self.names))
+        if self.mask is not None:
+            features["is_valid"] = self.mask
+        return features
+
+def build_matrix(args, names=None, dtype=np.float32, out=None):
+    """Write features to a single preallocated matrix
+    
+    Parameters
+    ----------
+    args : tuple or list of dict
+        a tuple of feature data structures
+    names : list of str, optional
+        names under which the column ranges of the features are stored
+    dtype : dtype, optional
+        data type of the matrix
+    out : FeatureMatrix, optional
+        matrix to reuse; a new one is allocated if it has a different 
+        shape or dtype
+    
+    Returns
+    -------
+    matrix : FeatureMatrix
+    """
+    
+    n_spikes = set(d['data'].shape[0] for d in args)
+    if len(n_spikes) > 1:
+        raise ValueError('all features must contain the same number of spikes')
+    n_spikes = n_spikes.pop()
+    n_features = sum(len(d['names']) for d in args)
+    
+    if (out is not None and out.data.shape == (n_spikes, n_features) and 
+        out.data.dtype == dtype):
+        matrix = out
+        matrix.clear()
+    else:
+        matrix = FeatureMatrix(n_spikes, n_features, dtype)
+    
+    if names is None:
+        names = [None]*len(args)
+    for feature_dict, name in zip(args, names):
+        matrix.add(feature_dict, name)
+    
+    return matrix
+
+def combine(args, norm=True, dtype=np.float64):
     """Combine features into a single structure
     
     Parameters
     ----------
     args : tuple or list of dict
         a tuple of feature data structures
+    norm : bool, optional
+        if True normalize the features (in place)
+    dtype : dtype, optional
+        data type of the combined features (float64 by default; float32
+        halves the memory of large feature sets)
     
     Returns
     -------
     combined_fetures : dict
     """
 
-    features = [d['data'] for d in args]
-    names = [d['names'] for d in args]
-    
-    #get mask, if it exist
-    mask = [d['is_valid'] for d in args if 'is_valid' in d]
+    matrix = build_matrix(args, dtype=dtype)
+    if norm:
+        matrix.normalize()
     
+    return matrix.to_dict()
+
+
+def _call_feature(spikes_data, func_name, args, kwargs):
+    feature_func = globals()[func_name]
+    return feature_func(spikes_data, *args, **kwargs)
+
+def _shm_feature_worker(shm_name, shape, dtype, spikes_meta, func_name,
+                        args, kwargs):
+    """Calculate a feature in a worker process from waveforms stored in
+    shared memory"""
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
     try:
-        if mask:
-            #combine masks using AND
-            mask = reduce(np.logical_and, mask)
-        data  = np.hstack(features)
-    except ValueError:
-        raise ValueError('all features must contain the same number of spikes')
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        data.flags.writeable = False
+        spikes_data = dict(spikes_meta, data=data)
+        feature_data = _call_feature(spikes_data, func_name, args, kwargs)
+        #do not return views on the shared block which is released below
+        feature_data['data'] = np.array(feature_data['data'])
+    finally:
+        shm.close()
+    return feature_data
+
+def _calc_features_shm(spikes_data, feature_list, n_jobs):
+    from multiprocessing import shared_memory
+
+    data = np.asarray(spikes_data['data'])
+    spikes_meta = dict((k, v) for k, v in spikes_data.items() if k != 'data')
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared[...] = data
+        with futures.ProcessPoolExecutor(n_jobs) as executor:
+            jobs = [executor.submit(_shm_feature_worker, shm.name,
+                                    data.shape, data.dtype, spikes_meta,
+                                    name, args, kwargs)
+                    for name, args, kwargs in feature_list]
+            feats = [job.result() for job in jobs]
+    finally:
+        shm.close()
+        shm.unlink()
+    return feats
+
+def calc_features(spikes_data, feature_list, n_jobs=1, backend='threads'):
+    """Calculate several features of the same spike waveforms
     
-    combined_features = {"data": data,
-                         "names":np.concatenate(names)}
-    if list(mask): combined_features["is_valid"] = mask
+    Parameters
+    ----------
+    spikes_data : dict
+        spike waveforms structure (see :ref:`spike_wave`)
+    feature_list : list of tuples
+        list of `(func_name, args, kwargs)` tuples, where `func_name` is
+        the name of one of the `fet*` functions of this module
+    n_jobs : int or None, optional
+        number of features to calculate concurrently; 1 (default) 
+        calculates features sequentially, None uses all CPUs
+    backend : {'threads', 'processes'}, optional
+        'threads' (default) run the feature functions in a thread pool
+        sharing the read-only waveform array; 'processes' copy the
+        waveforms once to shared memory and run the feature functions in
+        a process pool
     
-    if norm:
-        normalize(combined_features, copy=False)
+    Returns
+    -------
+    feats : list of dict
+        feature structures in the order of `feature_list`
 
+    Notes
+    -----
+    The feature functions do not depend on each other, so the results
+    do not depend on `n_jobs` and `backend`.
+    """
     
-    return combined_features
-
+    if n_jobs == 1 or len(feature_list) < 2:
+        return [_call_feature(spikes_data, *f) for f in feature_list]
+    
+    if backend == 'threads':
+        with futures.ThreadPoolExecutor(n_jobs) as executor:
+            jobs = [executor.submit(_call_feature, spikes_data, *f)
+                    for f in feature_list]
+            feats = [job.result() for job in jobs]
+    elif backend == 'processes':
+        feats = _calc_features_shm(spikes_data, feature_list, n_jobs)
+    else:
+        raise ValueError("backend must be either 'threads' or 'processes'")
+    return feats
 
 def add_mask(feature_function):
     """Decorator to copy mask from waveshapes to features"""
@@ -127,21 +394,216 @@ def add_mask(feature_function):
     
     
 
+def _normalize_data(data):
+    data -= data.min(0)[np.newaxis,:]
+    data /= data.max(0)[np.newaxis,:]
+
 def normalize(features, copy=True):
-    """Normalize features"""
+    """Normalize features to the range [0, 1]
+    
+    If `copy` is False and the features are floating point numbers, the
+    data are normalized in place.
+    """
     if copy:
         features_norm = features.copy()
     else:
         features_norm = features
         
     data = features_norm['data']
-    data = (data-data.min(0)[np.newaxis,:])
-    data = data/data.max(0)[np.newaxis,:]
+    if copy or not np.issubdtype(data.dtype, np.floating):
+        data = np.array(data, dtype=np.result_type(data.dtype, np.float32))
+    _normalize_data(data)
     
     features_norm['data'] = data
 
     return features_norm    
 
+class Normalizer(object):
+    """Feature normalization with parameters that can be reused.
+    
+    Unlike :py:func:`normalize`, which rescales each batch of features
+    with its own minimum and maximum, the normalizer is fitted once
+    (possibly incrementally on several batches) and then applies the
+    same transformation to all subsequent batches.
+    
+    Parameters
+    ----------
+    method : {'minmax', 'percentile'}
+        'minmax' maps the minimum and maximum of the fitted features to
+        [0, 1]; 'percentile' maps the `percentiles` instead, which is
+        robust to outliers
+    percentiles : tuple of float, optional
+        lower and upper percentile (only used with 'percentile' method)
+    max_samples : int, optional
+        number of spikes kept in a reservoir sample from which the
+        percentiles are calculated
+    seed : int, optional
+        seed of the random generator used for reservoir sampling
+    
+    Attributes
+    ----------
+    names : list
+        labels of the fitted features
+    lower, upper : array
+        values mapped to 0 and 1
+    n_samples : int
+        number of spikes the normalizer was fitted on
+    """
+    
+    def __init__(self, method='minmax', percentiles=(1., 99.), 
+                 max_samples=10000, seed=None):
+        if method not in ('minmax', 'percentile'):
+            raise ValueError("method must be either 'minmax' or 'percentile'")
+        self.method = method
+        self.percentiles = tuple(percentiles)
+        self.max_samples = int(max_samples)
+        self._rng = np.random.RandomState(seed)
+        self.reset()
+        
+    def reset(self):
+        """Forget the fitted parameters"""
+        self.names = None
+        self.lower = None
+        self.upper = None
+        self.n_samples = 0
+        self._reservoir = None
+    
+    @property
+    def is_fitted(self):
+        return self.lower is not None
+    
+    def _check_names(self, features):
+        names = [str(n) for n in features['names']]
+        if self.names is not None and names != self.names:
+            raise ValueError("features do not match the features the"
+                             " normalizer was fitted on")
+        return names
+    
+    def _update_reservoir(self, data):
+        k = self.max_samples
+        if self._reservoir is None:
+            self._reservoir = np.empty((k, data.shape[1]))
+        n_fill = max(min(k - self.n_samples, len(data)), 0)
+        self._reservoir[self.n_samples:self.n_samples+n_fill] = data[:n_fill]
+        data = data[n_fill:]
+        if len(data):
+            #reservoir sampling: i-th spike replaces a random element
+            #with probability k/(i+1)
+            n_seen = self.n_samples + n_fill + np.arange(len(data)) + 1
+            slots = (self._rng.random_sample(len(data))*n_seen).astype(int)
+            keep = slots < k
+            self._reservoir[slots[keep]] = data[keep]
+    
+    def partial_fit(self, features):
+        """Update the normalization parameters with a batch of features
+        
+        Only valid spikes (see `is_valid`) are taken into account.
+        """
+        names = self._check_names(features)
+        data = np.asarray(features['data'])
+        if 'is_valid' in features:
+            data = data[features['is_valid'], :]
+        if len(data) == 0:
+            return self
+        self.names = names
+        
+        if self.method == 'minmax':
+            lower, upper = data.min(0), data.max(0)
+            if self.is_fitted:
+                lower = np.minimum(lower, self.lower)
+                upper = np.maximum(upper, self.upper)
+        else:
+            self._update_reservoir(data)
+            n_res = min(self.n_samples + len(data), self.max_samples)
+            lower, upper = np.percentile(self._reservoir[:n_res], 
+                                         self.percentiles, axis=0)
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.n_samples += len(data)
+        return self
+    
+    def fit(self, features):
+        """Fit the normalization parameters to features"""
+        self.reset()
+        return self.partial_fit(features)
+    
+    def transform(self, features, copy=True):
+        """Normalize features using the fitted parameters
+        
+        Parameters
+        ----------
+        features : dict
+            features structure with the same features (`names`) as the
+            fitted ones
+        copy : bool, optional
+            if False and the features are floating point numbers,
+            normalize in place
+            
+        Returns
+        -------
+        features_norm : dict
+        """
+        if not self.is_fitted:
+            raise ValueError("normalizer must be fitted first")
+        self._check_names(features)
+        
+        features_norm = features.copy() if copy else features
+        data = features_norm['data']
+        if copy or not np.issubdtype(data.dtype, np.floating):
+            data = np.array(data, dtype=np.result_type(data.dtype, np.float32))
+        scale = self.upper - self.lower
+        scale[scale == 0] = 1
+        data -= self.lower
+        data /= scale
+        features_norm['data'] = data
+        return features_norm
+    
+    def fit_transform(self, features, copy=True):
+        return self.fit(features).transform(features, copy)
+    
+    def get_state(self):
+        """Return parameters of the normalizer as a dict of arrays"""
+        if not self.is_fitted:
+            raise ValueError("normalizer must be fitted first")
+        n_res = min(self.n_samples, self.max_samples)
+        reservoir = self._reservoir
+        if reservoir is None:
+            reservoir = np.empty((0, len(self.names)))
+        return {'method': self.method,
+                'percentiles': np.array(self.percentiles),
+                'max_samples': self.max_samples,
+                'names': np.array(self.names),
+                'lower': self.lower,
+                'upper': self.upper,
+                'n_samples': self.n_samples,
+                'reservoir': reservoir[:n_res]}
+    
+    @classmethod
+    def from_state(cls, state):
+        """Create a normalizer from parameters returned by `get_state`"""
+        normalizer = cls(str(state['method']), state['percentiles'], 
+                         int(state['max_samples']))
+        normalizer.names = [str(n) for n in state['names']]
+        normalizer.lower = np.asarray(state['lower'], dtype=np.float64)
+        normalizer.upper = np.asarray(state['upper'], dtype=np.float64)
+        normalizer.n_samples = int(state['n_samples'])
+        if normalizer.method == 'percentile':
+            reservoir = np.asarray(state['reservoir'])
+            normalizer._reservoir = np.empty((normalizer.max_samples,
+                                              reservoir.shape[1]))
+            normalizer._reservoir[:len(reservoir)] = reservoir
+        return normalizer
+    
+    def save(self, fname):
+        """Save the normalization parameters to a numpy `.npz` file"""
+        np.savez(fname, **self.get_state())
+        
+    @classmethod
+    def load(cls, fname):
+        """Load normalizer saved with :py:meth:`save`"""
+        with np.load(fname) as state:
+            return cls.from_state(dict(state))
+
 def PCA(data,ncomps=2):
     """Perfrom a principle component analysis.
 
@@ -176,6 +638,151 @@ def PCA(data,ncomps=2):
     score = score/np.sqrt(evals[:ncomps, np.newaxis])
     return evals,evecs,score
 
+#low-pass decomposition filters of orthonormal wavelets
+_WAVELETS = {
+    'haar': [0.7071067811865476, 0.7071067811865476],
+    'db2': [0.48296291314469025, 0.836516303737469, 
+            0.22414386804185735, -0.12940952255092145],
+    'db4': [0.23037781330885523, 0.7148465705525415, 
+            0.6308807679295904, -0.02798376941698385, 
+            -0.18703481171888114, 0.030841381835986965, 
+            0.032883011666982945, -0.010597401784997278]
+    }
+
+def _dwt_step(x, lo, hi):
+    """Single level of discrete wavelet transform along the first axis
+    of `x` (signal is extended by mirroring at the end)"""
+    if x.shape[0] % 2:
+        x = np.concatenate((x, x[-1:]), 0)
+    n_taps = len(lo)
+    if n_taps > 2:
+        x = np.concatenate((x, x[-1:-n_taps+1:-1]), 0)
+    n_out = (x.shape[0] - n_taps)//2 + 1
+    approx = np.zeros((n_out,) + x.shape[1:], dtype=x.dtype)
+    detail = np.zeros((n_out,) + x.shape[1:], dtype=x.dtype)
+    for j in range(n_taps):
+        x_j = x[j:j+2*n_out:2]
+        approx += lo[j]*x_j
+        detail += hi[j]*x_j
+    return approx, detail
+
+def wavedec(data, wavelet='haar', levels=4):
+    """Multi-level discrete wavelet decomposition of spike waveforms
+    
+    The transform is calculated along the first (time) axis for all
+    spikes and contacts at once.
+    
+    Parameters
+    ----------
+    data : array
+        (n_pts, ...) array of waveforms 
+    wavelet : {'haar', 'db2', 'db4'}
+        wavelet family
+    levels : int
+        number of decomposition levels (decomposition stops earlier if 
+        the approximation becomes shorter than the wavelet filter)
+    
+    Returns
+    -------
+    coefs : array
+        (n_coefs, ...) array of concatenated approximation coefficients
+        of the last level and detail coefficients (from the coarsest to
+        the finest level)
+    """
+    try:
+        lo = np.array(_WAVELETS[wavelet])
+    except KeyError:
+        raise ValueError("wavelet must be one of: %s" % 
+                         ", ".join(sorted(_WAVELETS)))
+    hi = lo[::-1]*(-1)**np.arange(len(lo))
+    
+    approx = np.asarray(data, dtype=np.result_type(data.dtype, np.float32))
+    details = []
+    for _ in range(levels):
+        if approx.shape[0] < len(lo):
+            break
+        approx, detail = _dwt_step(approx, lo, hi)
+        details.insert(0, detail)
+    return np.concatenate([approx] + details, 0)
+
+def _ks_normality(coefs):
+    """Kolmogorov-Smirnov distance of each column of `coefs` from the
+    normal distribution with the column's mean and std"""
+    n = coefs.shape[0]
+    std = coefs.std(0)
+    constant = std == 0
+    std[constant] = 1
+    z = np.sort((coefs - coefs.mean(0))/std, 0)
+    cdf = special.ndtr(z)
+    ecdf = np.arange(1, n + 1)[:, np.newaxis]*1./n
+    dist = np.maximum(ecdf - cdf, cdf - (ecdf - 1./n)).max(0)
+    #constant coefficients do not carry any information
+    dist[constant] = 0
+    return dist
+
+@add_mask
+def fetWavelet(spikes_data, ncomps=3, wavelet='haar', levels=4, 
+               contacts='all', max_samples=10000, seed=0):
+    """Wavelet coefficients of spike waveforms
+    
+    Waveforms are decomposed with discrete wavelet transform and on each
+    contact the `ncomps` coefficients whose distributions deviate most 
+    from normal distribution (Kolmogorov-Smirnov statistic) are chosen.
+    Such coefficients are usually multimodal, i.e. they separate units.
+    
+    Parameters
+    ----------
+    spikes_data : dict
+    ncomps : int, optional
+        number of coefficients per contact to retain; if None, all 
+        coefficients are returned
+    wavelet : {'haar', 'db2', 'db4'}, optional
+        wavelet family
+    levels : int, optional
+        number of decomposition levels
+    contacts : 'all' or list of int, optional
+        indices of contacts whose waveforms are decomposed
+    max_samples : int, optional
+        number of randomly selected spikes used to evaluate the
+        normality of the coefficients
+    seed : int or None, optional
+        seed of the random generator used to select the spikes; the
+        fixed default makes the chosen coefficients reproducible
+    
+    Returns
+    -------
+    features : dict
+    """
+    
+    spikes = _get_data(spikes_data, contacts)
+    if spikes.ndim < 3:
+        spikes = spikes[:, :, np.newaxis]
+    n_pts, n_spikes, n_channels = spikes.shape
+    
+    coefs = wavedec(spikes, wavelet, levels)
+    n_coefs = coefs.shape[0]
+    
+    if ncomps is None:
+        selected = np.repeat(np.arange(n_coefs)[:, np.newaxis], 
+                             n_channels, 1)
+    else:
+        if n_spikes > max_samples:
+            rng = np.random.RandomState(seed)
+            sample = rng.permutation(n_spikes)[:max_samples]
+            sample.sort()
+        else:
+            sample = slice(None)
+        ks_dist = np.vstack([_ks_normality(coefs[:, sample, i].T)
+                             for i in range(n_channels)]).T
+        selected = np.argsort(-ks_dist, 0, kind='mergesort')[:ncomps, :]
+    
+    channels = np.arange(n_channels)[:, np.newaxis]
+    data = coefs[selected.T, :, channels].reshape(-1, n_spikes).T
+    names = ["Ch%d:Wav%d" % (j, selected[i, j]) for j in range(n_channels)
+             for i in range(selected.shape[0])]
+    
+    return {'data': data, 'names': names}
+
 def _get_data(spk_dict, contacts):
     spikes = spk_dict["data"]
     if not contacts=="all":
@@ -224,13 +831,146 @@ def fetPCs(spikes_data,ncomps=2, contacts='all'):
     
     return {'data': sc, "names":names}
 
+_STATS_NAMES = {'p2p': 'P2P', 'peak': 'Peak', 'trough': 'Trough', 
+                'energy': 'Energy', 'width': 'Width', 
+                'peak_time': 'PeakTime'}
+
+def _iter_chunks(n, chunksize):
+    chunksize = int(chunksize)
+    for start in range(0, n, chunksize):
+        yield slice(start, min(start + chunksize, n))
+
+def _half_width(chunk, i_peak, peak):
+    """Number of samples around the peak above half of its amplitude
+    (in absolute value, so that negative peaks are handled too)"""
+    n_pts = chunk.shape[0]
+    pts = np.arange(n_pts).reshape((n_pts,) + (1,)*(chunk.ndim-1))
+    below = np.abs(chunk) < np.abs(peak)/2.
+    left = np.maximum.accumulate(np.where(below, pts, -1), 0)
+    right = np.minimum.accumulate(np.where(below, pts, n_pts)[::-1], 0)[::-1]
+    left = np.take_along_axis(left, i_peak[np.newaxis], 0)[0]
+    right = np.take_along_axis(right, i_peak[np.newaxis], 0)[0]
+    return right - left - 1
+
+def waveform_stats(spikes_data, stats=('p2p',), contacts='all',
+                   chunksize=10000):
+    """Calculate amplitude statistics of spike waveforms.
+    
+    All statistics are calculated in a single pass over chunks of
+    spikes, so that waveforms stored on disk (memory mapped or HDF5
+    arrays) are read only once and never loaded in full to the memory.
+    
+    Parameters
+    ----------
+    spikes_data : dict
+        spike waveforms structure
+    stats : sequence of str
+        statistics to calculate:
+        
+        * 'p2p' -- peak-to-peak amplitude
+        * 'peak' -- maximum
+        * 'trough' -- minimum
+        * 'energy' -- sum of squared samples
+        * 'width' -- width of the largest (positive or negative)
+          deflection at half of its amplitude (in ms if sampling
+          frequency `FS` is known, otherwise in samples)
+        * 'peak_time' -- time of the peak (in ms if `time` is known,
+          otherwise sample index)
+    contacts : list or 'all'
+        contacts to use
+    chunksize : int
+        number of spikes processed at once
+    
+    Returns
+    -------
+    stats_dict : dict
+        dictionary mapping names of statistics to (n_spikes, n_contacts)
+        arrays; floating point waveforms keep their precision
+    """
+    
+    for stat in stats:
+        if stat not in _STATS_NAMES:
+            raise ValueError("unknown statistic %s" % stat)
+    
+    data = spikes_data['data']
+    n_spikes = data.shape[1]
+    if data.ndim < 3:
+        n_contacts = 1
+    elif contacts == 'all':
+        n_contacts = data.shape[2]
+    else:
+        n_contacts = len(np.atleast_1d(contacts))
+    
+    dtype = np.result_type(data.dtype, np.float32)
+    results = dict((stat, np.empty((n_spikes, n_contacts), dtype=dtype)) 
+                   for stat in stats)
+    for sl in _iter_chunks(n_spikes, chunksize):
+        chunk = np.asarray(data[:, sl])
+        if chunk.ndim < 3:
+            chunk = chunk[:, :, np.newaxis]
+        chunk = _get_data({'data': chunk}, contacts)
+        
+        peak = chunk.max(0)
+        trough = chunk.min(0)
+        if 'peak' in results:
+            results['peak'][sl] = peak
+        if 'trough' in results:
+            results['trough'][sl] = trough
+        if 'p2p' in results:
+            results['p2p'][sl] = peak - trough
+        if 'energy' in results:
+            results['energy'][sl] = np.einsum('ijk,ijk->jk', chunk, chunk)
+        if 'width' in results:
+            i_extr = np.abs(chunk).argmax(0)
+            extr = np.take_along_axis(chunk, i_extr[np.newaxis], 0)[0]
+            results['width'][sl] = _half_width(chunk, i_extr, extr)
+        if 'peak_time' in results:
+            i_peak = chunk.argmax(0)
+            if 'time' in spikes_data:
+                results['peak_time'][sl] = np.asarray(spikes_data['time'])[i_peak]
+            else:
+                results['peak_time'][sl] = i_peak
+    
+    if 'width' in results and 'FS' in spikes_data:
+        results['width'] *= 1000./spikes_data['FS']
+    
+    return results
+
 @add_mask
-def fetP2P(spikes_data, contacts='all'):
+def fetWaveStats(spikes_data, stats=('p2p', 'peak', 'trough'), 
+                 contacts='all', chunksize=10000):
+    """Amplitude statistics of spike waveforms calculated in a single
+    pass over spike chunks.
+    
+    Parameters
+    ----------
+    spikes_data : dict
+    stats : sequence of str
+        statistics to calculate (see :py:func:`waveform_stats`)
+    chunksize : int
+        number of spikes processed at once
+        
+    Returns
+    -------
+    features : dict
+    """
+    
+    results = waveform_stats(spikes_data, stats, contacts, chunksize)
+    data = np.hstack([results[stat] for stat in stats])
+    names = ["Ch%d:%s" % (i, _STATS_NAMES[stat]) for stat in stats
+             for i in range(results[stat].shape[1])]
+    
+    return {'data': data, 'names': names}
+
+@add_mask
+def fetP2P(spikes_data, contacts='all', chunksize=10000):
     """Calculate peak-to-peak amplitudes of spike waveforms.
 
     Parameters
     ----------
     spikes : dict
+    chunksize : int
+        number of spikes processed at once
 
     Returns
     -------
@@ -253,11 +993,7 @@ def fetP2P(spikes_data, contacts='all'):
 
     """
 
-    spikes = _get_data(spikes_data, contacts)
-            
-    p2p=spikes.max(axis=0)-spikes.min(axis=0)
-    if p2p.ndim<2:
-        p2p=p2p[:,np.newaxis]
+    p2p = waveform_stats(spikes_data, ['p2p'], contacts, chunksize)['p2p']
 
     names = ["Ch%d:P2P" % i for i in range(p2p.shape[1])]
 
@@ -294,23 +1030,77 @@ def fetSpProjection(spikes_data, labels, cell_id=1):
     labels : array
         array of length equal to number of spikes that contains 
         cluster labels
-    cell_id : int
-        label of cell on which all spikes should be projected.
+    cell_id : int, sequence of ints or 'all'
+        label of cell on which all spikes should be projected. If a
+        sequence of labels or 'all' is given, spikes are projected on
+        the averaged waveforms of all these cells at once.
+    
+    Returns
+    -------
+    features : dict
+        for a single `cell_id` the features are the projections on each
+        contact; otherwise an array of (n_spikes, n_cells*n_contacts)
+        projections ordered by cell and then by contact
     
     Notes
     -----
     `labels` can be also a boolean array in which case only spikes for 
     which label is True value will be averaged to determine projection
     coefficient
+
+    Raises
+    ------
+    ValueError
+        if one of the requested cells has no spikes
     """ 
     
     spikes = spikes_data["data"]
+    labels = np.asarray(labels)
     
-    proj_matrix = np.mean(spikes[:, labels==cell_id, :],1)
-    projection = (proj_matrix[:,np.newaxis,:]*spikes).sum(0)
-    projection /= np.sqrt((spikes**2).sum(0)*(proj_matrix**2).sum(0))
+    if isinstance(cell_id, str) and cell_id == 'all':
+        cells = np.unique(labels)
+    else:
+        cells = np.atleast_1d(cell_id)
     
-    ncomps = len(projection)
-    names = ["Ch%d:Proj" % i for i in range(ncomps)]
-    return {'data': projection, 'names':names}
+    #index of the cell of each spike (-1 for spikes of other cells)
+    order = np.argsort(cells, kind='stable')
+    sorted_cells = cells[order]
+    pos = np.clip(np.searchsorted(sorted_cells, labels), 0, len(cells)-1)
+    cell_idx = np.where(sorted_cells[pos] == labels, order[pos], -1)
+    in_cell = cell_idx >= 0
+    cell_idx = cell_idx[in_cell]
     
+    n_cells = len(cells)
+    counts = np.bincount(cell_idx, minlength=n_cells)
+    if (counts == 0).any():
+        raise ValueError("no spikes with label(s) %s" %
+                         ", ".join(str(c) for c in cells[counts == 0]))
+    
+    #average waveforms of all cells: (n_cells, n_pts, n_contacts)
+    dtype = np.result_type(spikes.dtype, np.float32)
+    n_pts, n_spikes, n_contacts = spikes.shape
+    templates = np.empty((n_cells, n_pts, n_contacts), dtype=dtype)
+    for j in range(n_pts):
+        for i in range(n_contacts):
+            templates[:, j, i] = np.bincount(cell_idx,
+                                             spikes[j, in_cell, i],
+                                             minlength=n_cells)
+    templates /= counts[:, np.newaxis, np.newaxis]
+    
+    #projections of all spikes on all templates
+    projection = np.empty((n_spikes, n_cells, n_contacts), dtype=dtype)
+    for i in range(n_contacts):
+        projection[:, :, i] = np.dot(spikes[:, :, i].T, templates[:, :, i].T)
+    spike_norm = np.einsum('ijk,ijk->jk', spikes, spikes)
+    template_norm = (templates**2).sum(1)
+    projection /= np.sqrt(spike_norm[:, np.newaxis, :] *
+                          template_norm[np.newaxis, :, :])
+    
+    if np.ndim(cell_id) == 0 and not isinstance(cell_id, str):
+        names = ["Ch%d:Proj" % i for i in range(n_contacts)]
+        projection = projection[:, 0, :]
+    else:
+        names = ["Cell%s:Ch%d:Proj" % (c, i) for c in cells 
+                 for i in range(n_contacts)]
+        projection = projection.reshape(n_spikes, n_cells*n_contacts)
+    return {'data': projection, 'names':names}
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Gaussian mixture models fitted with the expectation-maximization (EM)
+algorithm.
+
+The implementation uses only numpy. Responsibilities are calculated in
+log-space in blocks of data points, so that the memory usage does not
+grow with the number of spikes beyond the data itself.
+"""
+
+import numpy as np
+from . import cluster
+
+def _logsumexp(a):
+    """log(sum(exp(a), 1)) calculated without overflow"""
+    a_max = a.max(1)
+    out = np.log(np.exp(a - a_max[:, np.newaxis]).sum(1))
+    out += a_max
+    return out
+
+class GMM(object):
+    """Gaussian mixture model
+
+    Parameters
+    ----------
+    n_components : int
+        number of mixture components (clusters)
+    cov_type : {'full', 'diag'}
+        type of covariance matrices
+    tol : float
+        iterations stop when the increase of the average log-likelihood
+        is lower than `tol`
+    max_iter : int
+        maximum number of EM iterations
+    init : 'k-means++' or dict
+        'k-means++' initializes the components with a short run of
+        k-means with k-means++ seeding; dict with keys 'means' and
+        optionally 'covars' and 'weights' gives initial parameters
+    reg_covar : float
+        constant added to the diagonal of covariance matrices
+    dtype : dtype
+        data type of calculations (float32 halves the memory and is
+        usually faster)
+    block_size : int
+        number of data points processed at once
+    seed : None, int or RandomState
+        random generator (or its seed) used for initialization
+    n_init : int
+        number of runs with different initializations; the run with the
+        highest likelihood is kept (see 
+        :py:func:`spike_sort.core.cluster.fit_restarts`)
+    n_jobs : int or None
+        number of processes used for the runs; by default all runs are
+        fitted in the calling process, None uses all CPUs
+
+    Attributes
+    ----------
+    weights : array
+        (n_components,) mixing weights
+    means : array
+        (n_components, n_features) means of components
+    covars : array
+        (n_components, n_features, n_features) covariance matrices for
+        'full' or (n_components, n_features) variances for 'diag' type
+    log_likelihood : float
+        average log-likelihood of the fitted data
+    converged : bool
+        True if the fit converged within `max_iter` iterations
+    n_iter : int
+        number of EM iterations run
+    scores, seeds : array
+        log-likelihoods and seeds of all runs (only if `n_init` > 1)
+    """
+
+    def __init__(self, n_components, cov_type='full', tol=1e-3,
+                 max_iter=100, init='k-means++', reg_covar=1e-6,
+                 dtype=np.float64, block_size=65536, seed=None, n_init=1,
+                 n_jobs=1):
+        if cov_type not in ('full', 'diag'):
+            raise ValueError("cov_type must be either 'full' or 'diag'")
+        self.n_components = n_components
+        self.cov_type = cov_type
+        self.tol = tol
+        self.max_iter = max_iter
+        self.init = init
+        self.reg_covar = reg_covar
+        self.dtype = dtype
+        self.block_size = int(block_size)
+        self.seed = seed
+        self.n_init = n_init
+        self.n_jobs = n_jobs
+        self.means = None
+
+    def _iter_blocks(self, n_pts):
+        for start in range(0, n_pts, self.block_size):
+            yield slice(start, min(start + self.block_size, n_pts))
+
+    def _set_params(self, weights, means, covars):
+        """Set parameters and precompute terms of the log-density"""
+        self.weights = weights
+        self.means = means
+        self.covars = covars
+        n_dims = means.shape[1]
+        if self.cov_type == 'full':
+            chol = np.linalg.cholesky(covars)
+            self._prec_chol = np.linalg.inv(chol)
+            log_det = 2*np.log(np.diagonal(chol, axis1=1, axis2=2)).sum(1)
+        else:
+            self._prec = 1./covars
+            log_det = np.log(covars).sum(1)
+        self._log_norm = (np.log(weights) - 0.5*log_det -
+                          0.5*n_dims*np.log(2*np.pi))
+
+    def _estimate_log_prob(self, x, x_sq=None):
+        """log of weighted densities of all components at points `x`"""
+        dtype = x.dtype
+        if self.cov_type == 'full':
+            log_prob = np.empty((x.shape[0], self.n_components), dtype=dtype)
+            for k in range(self.n_components):
+                prec_chol = self._prec_chol[k].T.astype(dtype)
+                y = np.dot(x, prec_chol)
+                y -= np.dot(self.means[k].astype(dtype), prec_chol)
+                log_prob[:, k] = np.einsum('ij,ij->i', y, y)
+        else:
+            if x_sq is None:
+                x_sq = x**2
+            prec = self._prec.astype(dtype)
+            means = self.means.astype(dtype)
+            log_prob = np.dot(x_sq, prec.T)
+            log_prob -= 2*np.dot(x, (means*prec).T)
+            log_prob += (means**2*prec).sum(1)
+        log_prob *= -0.5
+        log_prob += self._log_norm.astype(dtype)
+        return log_prob
+
+    def _m_step(self, resp_sum, x_sum, xx_sum, n_pts):
+        resp_sum = resp_sum + 10*np.finfo(np.float64).eps
+        weights = resp_sum/n_pts
+        means = x_sum/resp_sum[:, np.newaxis]
+        n_dims = means.shape[1]
+        if self.cov_type == 'full':
+            covars = xx_sum/resp_sum[:, np.newaxis, np.newaxis]
+            covars -= means[:, :, np.newaxis]*means[:, np.newaxis, :]
+            covars += self.reg_covar*np.eye(n_dims)
+        else:
+            covars = xx_sum/resp_sum[:, np.newaxis] - means**2
+            np.maximum(covars, 0, covars)
+            covars += self.reg_covar
+        return weights, means, covars
+
+    def _init_params(self, x, rng):
+        n_pts, n_dims = x.shape
+        K = self.n_components
+        if isinstance(self.init, dict):
+            means = np.asarray(self.init['means'], dtype=np.float64)
+            means = means - self._offset
+            if 'covars' in self.init:
+                covars = np.asarray(self.init['covars'], dtype=np.float64)
+            else:
+                var = x.var(0) + self.reg_covar
+                covars = (np.array([np.diag(var)]*K)
+                          if self.cov_type == 'full' else np.array([var]*K))
+            weights = np.asarray(self.init.get('weights', np.ones(K)*1./K),
+                                 dtype=np.float64)
+            return weights/weights.sum(), means, covars
+        if self.init != 'k-means++':
+            raise ValueError("unknown initialization method %s" % self.init)
+
+        labels = cluster.KMeans(K, max_iter=10, seed=rng).fit(x).labels
+        resp_sum = np.bincount(labels, minlength=K).astype(np.float64)
+        x_sum, xx_sum = self._accumulate(x, np.eye(K, dtype=x.dtype)[labels])
+        return self._m_step(resp_sum, x_sum, xx_sum, n_pts)
+
+    def _accumulate(self, x, resp, x_sq=None):
+        """Weighted sums of data points and their second moments"""
+        x_sum = np.dot(resp.T, x).astype(np.float64)
+        if self.cov_type == 'full':
+            xx_sum = np.empty((resp.shape[1], x.shape[1], x.shape[1]))
+            for k in range(resp.shape[1]):
+                xx_sum[k] = np.dot((x*resp[:, k:k+1]).T, x)
+        else:
+            if x_sq is None:
+                x_sq = x**2
+            xx_sum = np.dot(resp.T, x_sq).astype(np.float64)
+        return x_sum, xx_sum
+
+    def fit(self, data):
+        """Fit the mixture to data of shape (n_points, n_features)"""
+        if self.n_init > 1:
+            return cluster.fit_restarts(self, data, 'log_likelihood')
+        return self._fit_single(data)
+
+    def _fit_single(self, data):
+        x = np.asarray(data, dtype=self.dtype)
+        n_pts, n_dims = x.shape
+        K = self.n_components
+        if n_pts < K:
+            raise ValueError("number of points must be larger than the"
+                             " number of components")
+        rng = cluster._check_random_state(self.seed)
+
+        #centering the data reduces round-off errors of the second moments
+        self._offset = x.mean(0).astype(np.float64)
+        x = x - self._offset.astype(self.dtype)
+        self._set_params(*self._init_params(x, rng))
+
+        log_likelihood = -np.inf
+        self.converged = False
+        for n_iter in range(1, self.max_iter + 1):
+            resp_sum = np.zeros(K)
+            x_sum = np.zeros((K, n_dims))
+            xx_sum = np.zeros((K, n_dims, n_dims) if self.cov_type == 'full'
+                              else (K, n_dims))
+            total = 0.
+            for sl in self._iter_blocks(n_pts):
+                x_block = x[sl]
+                x_sq = x_block**2 if self.cov_type == 'diag' else None
+                log_resp = self._estimate_log_prob(x_block, x_sq)
+                log_prob_norm = _logsumexp(log_resp)
+                total += log_prob_norm.sum(dtype=np.float64)
+                log_resp -= log_prob_norm[:, np.newaxis]
+                resp = np.exp(log_resp, log_resp)
+                resp_sum += resp.sum(0, dtype=np.float64)
+                block_sums = self._accumulate(x_block, resp, x_sq)
+                x_sum += block_sums[0]
+                xx_sum += block_sums[1]
+
+            prev_log_likelihood, log_likelihood = log_likelihood, total/n_pts
+            if abs(log_likelihood - prev_log_likelihood) < self.tol:
+                self.converged = True
+                break
+            self._set_params(*self._m_step(resp_sum, x_sum, xx_sum, n_pts))
+
+        self.log_likelihood = log_likelihood
+        self.n_iter = n_iter
+        self._set_params(self.weights, self.means + self._offset,
+                         self.covars)
+        return self
+
+    def _log_resp_blocks(self, data):
+        x = np.asarray(data, dtype=self.dtype)
+        for sl in self._iter_blocks(x.shape[0]):
+            log_prob = self._estimate_log_prob(x[sl])
+            yield sl, log_prob, _logsumexp(log_prob)
+
+    def score_samples(self, data):
+        """Log-likelihood of each data point"""
+        out = np.empty(len(data))
+        for sl, _, log_prob_norm in self._log_resp_blocks(data):
+            out[sl] = log_prob_norm
+        return out
+
+    def score(self, data):
+        """Average log-likelihood of data"""
+        return self.score_samples(data).mean()
+
+    def predict(self, data):
+        """Assign data points to the most probable components"""
+        labels = np.empty(len(data), dtype=int)
+        for sl, log_prob, _ in self._log_resp_blocks(data):
+            labels[sl] = log_prob.argmax(1)
+        return labels
+
+    def predict_proba(self, data):
+        """Probabilities of components (responsibilities)"""
+        proba = np.empty((len(data), self.n_components))
+        for sl, log_prob, log_prob_norm in self._log_resp_blocks(data):
+            proba[sl] = np.exp(log_prob - log_prob_norm[:, np.newaxis])
+        return proba
+
+    def n_parameters(self):
+        """Number of free parameters of the model"""
+        K, n_dims = self.means.shape
+        if self.cov_type == 'full':
+            cov_params = K*n_dims*(n_dims + 1)/2.
+        else:
+            cov_params = K*n_dims
+        return int(cov_params + K*n_dims + K - 1)
+
+    def bic(self, data):
+        """Bayesian information criterion (lower is better)"""
+        return (-2*self.score(data)*len(data) +
+                self.n_parameters()*np.log(len(data)))
+
+    def aic(self, data):
+        """Akaike information criterion (lower is better)"""
+        return -2*self.score(data)*len(data) + 2*self.n_parameters()
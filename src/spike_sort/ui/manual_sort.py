@@ -9,6 +9,7 @@ from numpy import nonzero
 import numpy as np
 import matplotlib.pyplot as plt
 from spike_sort.ui import plotting
+from spike_sort.core import features
 
 import time
 
@@ -74,14 +75,9 @@ class LassoManager:
 
 def manual_sort(features_dict,feat_idx):
     
-    features = features_dict['data']
-    names = features_dict['names']
-    if type(feat_idx[0]) is int:
-        ii = np.array(feat_idx)
-    else:
-        ii = np.array([np.nonzero(names==f)[0][0] for f in feat_idx])
+    selected = features.select(features_dict, feat_idx)
 
-    return _cluster(features[:,ii], names[:,ii])
+    return _cluster(selected['data'], selected['names'])
     
 def _cluster(data, names=None):
     fig_cluster = figure(figsize=(6,6))
@@ -1,4 +1,5 @@
 from spike_beans import base, components
+from spike_sort import features
 from nose.tools import ok_,raises
 from nose import with_setup
 import numpy as np
@@ -115,7 +116,7 @@ class DummySpikeSource(base.Component):
     def __init__(self):
         n_pts = 100
         spike_shape = np.zeros(n_pts)
-        spike_shape[n_pts/2] = 1.
+        spike_shape[n_pts//2] = 1.
         data = spike_shape[:,np.newaxis, np.newaxis]*np.ones(n_spikes-2)[np.newaxis,:,np.newaxis]
         self._sp_waves = {'data':data, 'time':np.ones(n_pts)*1000./FS}
     def read_spikes(self):
@@ -255,9 +256,44 @@ def test_feature_extractor():
     features = feat_comp.features
     
     ok_((features['data']==spike_amp).all())       
+    ok_(features['data'].dtype == np.float32)
+    method, = feat_comp.feature_methods
+    ok_((method(base.features["SpikeSource"].spikes)['data'] == 
+         spike_amp).all())
 
 
 
+@with_setup(setup, teardown)
+def test_feature_extractor_parallel():
+    base.features.Provide("SignalSource",      DummySignalSource())
+    base.features.Provide("SpikeMarkerSource", DummySpikeDetector())
+    base.features.Provide("SpikeSource",       components.SpikeExtractor())
+    
+    feat_comp = components.FeatureExtractor(normalize=False, n_jobs=2)
+    feat_comp.add_feature("P2P")
+    feat_comp.add_feature("SpIdx")
+    features = feat_comp.features
+    
+    ok_((features['data'][:,0]==spike_amp).all())
+    ok_(list(features['names'])==["Ch0:P2P", "SpIdx"])
+
+@with_setup(setup, teardown)
+def test_feature_extractor_normalizer():
+    base.features.Provide("SignalSource",      DummySignalSource())
+    base.features.Provide("SpikeMarkerSource", DummySpikeDetector())
+    base.features.Provide("SpikeSource",       components.SpikeExtractor())
+    
+    normalizer = features.Normalizer()
+    feat_comp = components.FeatureExtractor(normalize=normalizer)
+    feat_comp.add_feature("SpIdx")
+    fet = feat_comp.features
+    ok_(normalizer.is_fitted)
+    ok_(fet['data'].max() == 1)
+    
+    normalizer.upper = 2*normalizer.upper
+    feat_comp.update()
+    ok_(feat_comp.features['data'].max() == 0.5)
+
 @with_setup(setup, teardown)
 def test_cluster_component():
     base.features.Provide("FeatureSource", DummyFeatureExtractor())
@@ -270,6 +306,144 @@ def test_cluster_component():
     ok_(ok)
     
 
+@with_setup(setup, teardown)
+def test_cluster_component_use_features():
+    base.features.Provide("FeatureSource", DummyFeatureExtractor())
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 2)
+    cluster_comp.use_features = ["Fet1"]
+    labels = cluster_comp.labels
+    
+    ok_((labels[:n_spikes]!=labels[n_spikes:]).all())
+
+@with_setup(setup, teardown)
+def test_cluster_component_fit_size():
+    base.features.Provide("FeatureSource", DummyFeatureExtractor())
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 2)
+    cluster_comp.fit_size = 10
+    labels = cluster_comp.labels
+    
+    ok_((labels[:n_spikes]!=labels[n_spikes:]).all())
+
+@with_setup(setup, teardown)
+def test_cluster_component_export_model():
+    base.features.Provide("FeatureSource", DummyFeatureExtractor())
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 2)
+    labels = cluster_comp.labels
+    model = cluster_comp.export_model(with_features=False)
+    
+    new_labels = model.predict(base.features["FeatureSource"].features)
+    ok_((new_labels == labels).all())
+
+@raises(ValueError)
+@with_setup(setup, teardown)
+def test_cluster_component_export_model_no_specs():
+    base.features.Provide("FeatureSource", DummyFeatureExtractor())
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 2)
+    cluster_comp.export_model()
+
+@with_setup(setup, teardown)
+def test_cluster_component_export_model_normalized():
+    n_pts = 20
+    amps = np.repeat([[1., 3.], [3., 1.]], [60, 140], 0)
+    amps += 0.1*np.random.randn(*amps.shape)
+    shape = np.sin(np.linspace(0, 2*np.pi, n_pts))
+    data = shape[:, np.newaxis, np.newaxis]*amps[np.newaxis, :, :]
+    spikes = {'data': data, 'time': np.arange(n_pts)*1000./FS, 'FS': FS}
+    spike_src = DummySpikeSource()
+    spike_src._sp_waves = spikes
+    base.features.Provide("SpikeSource", spike_src)
+    base.features.Provide("FeatureSource", 
+                          components.FeatureExtractor(normalize=True))
+    base.features["FeatureSource"].add_feature("P2P")
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 2)
+    labels = cluster_comp.labels
+    model = cluster_comp.export_model()
+    
+    #the spikes of a single cell normalized by their own range would
+    #not match the clusters
+    cell = labels == labels[0]
+    cell_spikes = dict(spikes, data=data[:, cell, :])
+    new_labels = model.sort(cell_spikes)
+    ok_((new_labels == labels[0]).all())
+
+@with_setup(setup, teardown)
+def test_cluster_component_warm_start():
+    feature_src = DummyFeatureExtractor()
+    base.features.Provide("FeatureSource", feature_src)
+    
+    cluster_comp = components.ClusterAnalyzer("gmm", 2)
+    cluster_comp.warm_start = True
+    cluster_comp.cluster_labels = np.repeat([7, 3], n_spikes)
+    cluster_comp.delete_spikes([0])
+    
+    feature_src._features['data'] = feature_src._features['data'] + \
+                                    0.01*np.random.randn(2*n_spikes, 2)
+    cluster_comp.update()
+    labels = cluster_comp.labels
+    
+    ok_(labels[0] == cluster_comp.trash_label)
+    ok_((labels[1:n_spikes] == 7).all())
+    ok_((labels[n_spikes:] == 3).all())
+
+@with_setup(setup, teardown)
+def test_cluster_component_stats():
+    feature_src = DummyFeatureExtractor()
+    feature_src._features['data'] = np.random.randn(2*n_spikes, 2)
+    base.features.Provide("FeatureSource", feature_src)
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 5)
+    cluster_comp.stats_covariance = True
+    stats = cluster_comp.stats
+    cluster_comp.merge_cells(1, 2)
+    cluster_comp.delete_cells(3)
+    cluster_comp.delete_spikes([0, 1, 1])
+    cluster_comp.recluster(4, 'k_means', 2)
+    cluster_comp.relabel()
+    
+    data = base.features["FeatureSource"].features['data']
+    labels = cluster_comp.labels
+    ok_(stats is cluster_comp.stats)
+    ok_(stats.labels == list(np.unique(labels)))
+    for label in stats.labels:
+        cell_data = data[labels==label]
+        ok_(stats.count(label) == len(cell_data))
+        ok_(np.allclose(stats.mean(label), cell_data.mean(0)))
+        ok_(np.allclose(stats.cov(label), np.cov(cell_data.T, bias=True)))
+
+@with_setup(setup, teardown)
+def test_cluster_component_many_labels():
+    feature_src = DummyFeatureExtractor()
+    feature_src._features['data'] = np.random.randn(2*n_spikes, 2)
+    base.features.Provide("FeatureSource", feature_src)
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 2)
+    labels = np.arange(2*n_spikes) + 1
+    labels[-10:] = labels[-10]
+    cluster_comp.cluster_labels = labels
+    cluster_comp.recluster(labels[-1], 'k_means', 2)
+    new_labels = np.unique(cluster_comp.labels[-10:])
+    ok_((new_labels == [2*n_spikes-8, 2*n_spikes-7]).all())
+    
+    cluster_comp.merge_cells(5, 7, 2*n_spikes-8)
+    ok_((cluster_comp.labels[[4, 6]] == 5).all())
+    cluster_comp.relabel()
+    ok_((np.unique(cluster_comp.labels) == 
+         np.arange(2*n_spikes-10)+1).all())
+
+@raises(ValueError)
+@with_setup(setup, teardown)
+def test_cluster_component_missing_feature():
+    base.features.Provide("FeatureSource", DummyFeatureExtractor())
+    
+    cluster_comp = components.ClusterAnalyzer("k_means", 2)
+    cluster_comp.use_features = ["Fet5"]
+    cluster_comp.labels
+
 @with_setup(setup, teardown)
 def test_cluster_component_relabel():
     base.features.Provide("FeatureSource", RandomFeatures())
@@ -6,6 +6,8 @@ from nose.tools import ok_, eq_, raises
 from numpy.testing import assert_array_almost_equal as almost_equal
 from numpy.testing import assert_allclose as allclose
 
+from scipy import stats
+
 import warnings
 
 class TestExtract:
@@ -172,6 +174,18 @@ class TestExtract:
         spt_filt = ss.extract.filter_spt(self.spk_data, spt_dict, sp_win)
         ok_(len(spt_filt)==(self.n_spikes-1))
         
+    def test_remove_spikes(self):
+        spt = np.sort(np.random.rand(500)*1000)
+        spt_remove = np.random.rand(50)*1000
+        tolerance = [-0.4, 0.8]
+        spt_ref = spt
+        for t in spt_remove:
+            spt_ref = spt_ref[(spt_ref>(t+tolerance[1])) | 
+                              (spt_ref<(t+tolerance[0]))]
+        spt_new = ss.extract.remove_spikes({'data': spt}, 
+                                           {'data': spt_remove}, tolerance)
+        ok_((spt_new['data'] == spt_ref).all())
+        
 
 class TestFeatures:
 
@@ -203,6 +217,49 @@ class TestFeatures:
         
         ok_((p2p['data']==amps*self.gain).all())
 
+    def test_fetP2P_chunked(self):
+        spikes_dict = self.spikes_dict.copy()
+        spikes_dict['data'] = np.random.randn(50, 105, 2)
+        p2p = ss.features.fetP2P(spikes_dict, chunksize=10)
+        data = spikes_dict['data']
+        almost_equal(p2p['data'], data.max(0)-data.min(0))
+        eq_(p2p['data'].dtype, np.float64)
+        
+        spikes_dict['data'] = data.astype(np.float32)
+        p2p = ss.features.fetP2P(spikes_dict, chunksize=10)
+        eq_(p2p['data'].dtype, np.float32)
+        
+    def test_fetWaveStats(self):
+        spikes_dict = self.spikes_dict.copy()
+        n_pts = len(spikes_dict['time'])
+        spikes = np.zeros((n_pts, 5, 1))
+        spikes[40:50, :, 0] = 2.
+        spikes[45, :, 0] = 4.
+        spikes[60:65, :, 0] = -1.
+        spikes_dict['data'] = spikes
+        stats = ss.features.fetWaveStats(spikes_dict, 
+                                        ['p2p', 'peak', 'trough', 'energy',
+                                         'width', 'peak_time'], 
+                                        chunksize=2)
+        eq_(list(stats['names']), ['Ch0:P2P', 'Ch0:Peak', 'Ch0:Trough',
+                                   'Ch0:Energy', 'Ch0:Width', 
+                                   'Ch0:PeakTime'])
+        dt = 1000./spikes_dict['FS']
+        almost_equal(stats['data'][0], [5., 4., -1., 9*4+16+5, 10*dt, 
+                                        spikes_dict['time'][45]])
+        
+    def test_fetWaveStats_negative_width(self):
+        spikes_dict = self.spikes_dict.copy()
+        n_pts = len(spikes_dict['time'])
+        spikes = np.zeros((n_pts, 5, 1))
+        spikes[40:50, :, 0] = -2.
+        spikes[45, :, 0] = -4.
+        spikes[60:65, :, 0] = 1.
+        spikes_dict['data'] = spikes
+        stats = ss.features.fetWaveStats(spikes_dict, ['width'])
+        dt = 1000./spikes_dict['FS']
+        almost_equal(stats['data'][:, 0], np.repeat(10*dt, 5))
+        
     def test_PCA(self):
         n_dim = 2
         n_obs = 100
@@ -248,6 +305,77 @@ class TestFeatures:
         feat = ss.features.fetSpProjection(spikes_dict, labels)
         ok_(((feat['data'][:,0]>0.5) == labels).all())
         
+    def test_calc_features_parallel(self):
+        spikes_dict = self.spikes_dict.copy()
+        spikes_dict['data'] = np.random.randn(50, 200, 2)
+        feature_list = [('fetP2P', (), {}), 
+                        ('fetPCs', (), {'ncomps':2}),
+                        ('fetSpIdx', (), {})]
+        serial = ss.features.calc_features(spikes_dict, feature_list)
+        for backend in ['threads', 'processes']:
+            feats = ss.features.calc_features(spikes_dict, feature_list,
+                                              n_jobs=2, backend=backend)
+            for f1, f2 in zip(serial, feats):
+                ok_((f1['data']==f2['data']).all())
+                ok_(list(f1['names'])==list(f2['names']))
+        
+    def test_getSpProjection_all_cells(self):
+        spikes_dict = self.spikes_dict.copy()
+        cells = spikes_dict['data']
+        spikes_dict['data'] = np.repeat(cells, 10, 1)
+        labels = np.repeat([0,1], 10,0)
+        
+        feat = ss.features.fetSpProjection(spikes_dict, labels, 'all')
+        single = ss.features.fetSpProjection(spikes_dict, labels, 1)
+        eq_(feat['data'].shape, (20, 2))
+        eq_(list(feat['names']), ['Cell0:Ch0:Proj', 'Cell1:Ch0:Proj'])
+        almost_equal(feat['data'][:, 1], single['data'][:, 0])
+        ok_(((feat['data'][:,0]>0.5) == (labels==0)).all())
+
+    def test_getSpProjection_cell_order(self):
+        spikes_dict = self.spikes_dict.copy()
+        cells = spikes_dict['data']
+        spikes_dict['data'] = np.repeat(cells, 10, 1)
+        labels = np.repeat([0,1], 10,0)
+        
+        feat = ss.features.fetSpProjection(spikes_dict, labels, [1, 0])
+        single = ss.features.fetSpProjection(spikes_dict, labels, 0)
+        eq_(list(feat['names']), ['Cell1:Ch0:Proj', 'Cell0:Ch0:Proj'])
+        almost_equal(feat['data'][:, 1], single['data'][:, 0])
+        
+    @raises(ValueError)
+    def test_getSpProjection_empty_cell(self):
+        spikes_dict = self.spikes_dict.copy()
+        labels = np.zeros(spikes_dict['data'].shape[1], dtype=int)
+        ss.features.fetSpProjection(spikes_dict, labels, [0, 3])
+        
+    def test_wavedec_haar(self):
+        data = np.random.randn(32, 10, 2)
+        coefs = ss.features.wavedec(data, 'haar', 3)
+        eq_(coefs.shape, data.shape)
+        almost_equal((coefs**2).sum(0), (data**2).sum(0))
+        
+    def test_fetWavelet(self):
+        n_spikes = 200
+        time = self.spikes_dict['time']
+        labels = np.random.rand(n_spikes) > 0.5
+        spikes = np.sin(2*np.pi*time)[:, np.newaxis]*np.ones(n_spikes)
+        spikes += 0.1*np.random.randn(*spikes.shape)
+        spikes[60:70, labels] += 1.
+        spikes_dict = {'data':spikes[:, :, np.newaxis], 'time':time}
+        
+        wav = ss.features.fetWavelet(spikes_dict, ncomps=1)
+        eq_(wav['data'].shape, (n_spikes, 1))
+        corr = np.corrcoef(wav['data'][:, 0], labels)[0, 1]
+        ok_(np.abs(corr) > 0.9)
+        
+    def test_fetWavelet_reproducible(self):
+        spikes_dict = {'data': np.random.randn(32, 300, 1)}
+        wav1 = ss.features.fetWavelet(spikes_dict, max_samples=50)
+        wav2 = ss.features.fetWavelet(spikes_dict, max_samples=50)
+        eq_(wav1['names'], wav2['names'])
+        ok_((wav1['data'] == wav2['data']).all())
+        
     def test_add_mask_decorator(self):
         spikes_dict = {'data':np.zeros((10,2)), 
                        'is_valid':np.zeros(2, )}
@@ -283,6 +411,109 @@ class TestFeatures:
         combined = ss.features.combine((feature1, feature2))
         ok_((combined['is_valid']==(mask1 & mask2)).all())   
         
+    def test_combine_normalize(self):
+        feature1 = {'data':np.random.uniform(size=(5, 2)), 
+                    'names': ['feature1', 'feature2']}
+        feature2 = {'data':np.arange(5)[:,np.newaxis], 'names': ['feature3']}
+        combined = ss.features.combine((feature1, feature2))
+        ok_(combined['data'].dtype == np.float64)
+        combined32 = ss.features.combine((feature1, feature2), 
+                                         dtype=np.float32)
+        ok_(combined32['data'].dtype == np.float32)
+        almost_equal(combined['data'].min(0), np.zeros(3))
+        almost_equal(combined['data'].max(0), np.ones(3))
+        ok_(list(combined['names'])==['feature1', 'feature2', 'feature3'])
+    
+    def test_build_matrix_reuse(self):
+        feature1 = {'data':np.random.uniform(size=(5, 2)), 
+                    'names': ['feature1', 'feature2']}
+        feature2 = {'data':np.random.uniform(size=(5, 1)), 'names': ['feature3']}
+        matrix = ss.features.build_matrix((feature1, feature2), 
+                                          names=['fet1', 'fet2'])
+        eq_(matrix.ranges, {'fet1':(0, 2), 'fet2':(2, 3)})
+        almost_equal(matrix.data[:, 2], feature2['data'][:, 0])
+        new_matrix = ss.features.build_matrix((feature2, feature1), 
+                                              out=matrix)
+        ok_(new_matrix is matrix)
+        almost_equal(matrix.data[:, 0], feature2['data'][:, 0])
+
+    def test_normalize_copy(self):
+        data = np.random.uniform(size=(5, 2))
+        features = {'data':data.copy(), 'names':['feature1', 'feature2']}
+        ss.features.normalize(features)
+        ok_((features['data']==data).all())
+        
+    def test_select_features(self):
+        features = {'data':np.random.randn(10, 4), 
+                    'names':np.array(['a', 'b', 'c', 'd']),
+                    'is_valid':np.ones(10, dtype=bool)}
+        selected = ss.features.select(features, ['b', 'c'])
+        ok_(np.may_share_memory(selected['data'], features['data']))
+        ok_((selected['data']==features['data'][:, 1:3]).all())
+        ok_(list(selected['names'])==['b', 'c'])
+        ok_('is_valid' in selected)
+        selected = ss.features.select(features, ['d', 0])
+        ok_((selected['data']==features['data'][:, [3, 0]]).all())
+        
+    def test_feature_table_index(self):
+        table = ss.features.FeatureTable(data=np.random.randn(10, 3),
+                                         names=['a', 'b', 'c'])
+        eq_(table.index['c'], 2)
+        ok_((table.column('b')==table['data'][:, 1]).all())
+        table['names'] = ['c', 'b', 'a']
+        eq_(table.index['c'], 0)
+        ok_(isinstance(table.copy(), ss.features.FeatureTable))
+    
+    @raises(KeyError)
+    def test_select_missing_feature(self):
+        features = {'data':np.random.randn(10, 2), 'names':['a', 'b']}
+        ss.features.select(features, ['x'])
+
+    def test_normalizer_partial_fit(self):
+        data = np.random.randn(100, 2)
+        features = {'data':data, 'names':['feature1', 'feature2']}
+        normalizer = ss.features.Normalizer()
+        normalizer.partial_fit(ss.features.select_spikes(features, 
+                                                         slice(0, 50)))
+        normalizer.partial_fit(ss.features.select_spikes(features, 
+                                                         slice(50, 100)))
+        norm = normalizer.transform(features)
+        almost_equal(norm['data'], 
+                     ss.features.normalize(features)['data'])
+        
+    def test_normalizer_percentile_robust(self):
+        data = np.random.rand(1000, 1)
+        data[0] = 1000.
+        features = {'data':data, 'names':['feature1']}
+        normalizer = ss.features.Normalizer('percentile', (0, 99), 
+                                            max_samples=2000)
+        normalizer.fit(features)
+        ok_(normalizer.upper[0] < 1.)
+        
+    @raises(ValueError)
+    def test_normalizer_names_mismatch(self):
+        features = {'data':np.random.rand(10, 1), 'names':['feature1']}
+        normalizer = ss.features.Normalizer().fit(features)
+        features['names'] = ['feature2']
+        normalizer.transform(features)
+    
+    def test_normalizer_save_load(self):
+        import tempfile, os
+        features = {'data':np.random.randn(100, 2), 
+                    'names':['feature1', 'feature2']}
+        normalizer = ss.features.Normalizer('percentile').fit(features)
+        fid, fname = tempfile.mkstemp(suffix='.npz')
+        os.close(fid)
+        try:
+            normalizer.save(fname)
+            loaded = ss.features.Normalizer.load(fname)
+        finally:
+            os.unlink(fname)
+        new_features = {'data':np.random.randn(10, 2), 
+                        'names':['feature1', 'feature2']}
+        almost_equal(loaded.transform(new_features)['data'],
+                     normalizer.transform(new_features)['data'])
+        
 class TestCluster:
     """test clustering algorithms"""
     
@@ -309,6 +540,27 @@ class TestCluster:
         cl = ss.cluster.cluster('k_means', self.features, self.K)
         ok_(self._cmp_bin_partitions(cl, self.labels))
     
+    def test_mini_batch_k_means(self):
+        cl = ss.cluster.cluster('mini_batch_k_means', self.features, self.K,
+                                batch_size=50)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+    
+    def test_k_means_max_iter(self):
+        model = ss.cluster.KMeans(self.K, max_iter=1, init='random')
+        model.fit(self.features['data'])
+        eq_(model.n_iter, 1)
+        
+    def test_k_means_reseed_empty_cluster(self):
+        init = np.array([[0.5, 0.5], [100., 100.]])
+        model = ss.cluster.KMeans(self.K, init=init)
+        model.fit(self.features['data'])
+        ok_(self._cmp_bin_partitions(model.labels, self.labels))
+        
+    def test_k_means_seed(self):
+        cl1 = ss.cluster.cluster('k_means', self.features, 5, seed=1)
+        cl2 = ss.cluster.cluster('k_means', self.features, 5, seed=1)
+        ok_((cl1==cl2).all())
+    
     def test_k_means_plus(self):
         """test scikits k-means plus algorithm"""
         
@@ -320,14 +572,401 @@ class TestCluster:
         
         cl = ss.cluster.cluster('gmm', self.features, self.K)
         ok_(self._cmp_bin_partitions(cl, self.labels))
+
+    def test_gmm_diag_float32(self):
+        cl = ss.cluster.cluster('gmm', self.features, self.K, 
+                                cov_type='diag', dtype=np.float32)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+        
+    def test_gmm_model(self):
+        from spike_sort.core import mixture
+        data = self.features['data']
+        model = mixture.GMM(self.K, seed=1, block_size=64).fit(data)
+        ok_(model.converged)
+        almost_equal(model.weights, [0.5, 0.5])
+        almost_equal(np.sort(model.means[:, 0]), [0.5, 2.5], 1)
+        almost_equal(model.predict_proba(data).sum(1), np.ones(len(data)))
+        ok_(model.bic(data) < mixture.GMM(1).fit(data).bic(data))
+    
+    def test_cluster_subsample(self):
+        features = dict(self.features)
+        features['is_valid'] = np.ones(len(self.labels), dtype=bool)
+        features['is_valid'][::7] = False
+        cl = ss.cluster.cluster_subsample('k_means', features, 20, 
+                                          self.K, seed=1)
+        ok_((cl[::7]==-1).all())
+        valid = features['is_valid']
+        ok_(self._cmp_bin_partitions(cl[valid], self.labels[valid]))
+    
+    def test_cluster_subsample_centroid(self):
+        cl = ss.cluster.cluster_subsample(lambda data: data[:, 0] > 1,
+                                          self.features, 20)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+        
+    def test_select_model(self):
+        labels, scores = ss.cluster.select_model(self.features['data'], 
+                                                 range(1, 4), n_init=2, 
+                                                 n_jobs=1, seed=1)
+        ok_(self._cmp_bin_partitions(labels, self.labels))
+        eq_(len(scores), 6)
+        eq_(scores['k'][scores['score'].argmin()], 2)
+        
+    def test_select_model_no_refit(self):
+        fitted = []
+        def counting_model(k, **kwargs):
+            fitted.append(k)
+            return ss.cluster.KMeans(k, **kwargs)
+        ss.cluster.register_method('test_counting', ss.cluster.k_means,
+                                   counting_model)
+        labels, scores = ss.cluster.select_model(self.features['data'],
+                                                 range(2, 4), 'test_counting',
+                                                 'silhouette', n_init=2,
+                                                 n_jobs=1, seed=1)
+        eq_(len(fitted), 4)
+        ok_(self._cmp_bin_partitions(labels, self.labels))
+    
+    def test_select_model_parallel(self):
+        serial = ss.cluster.select_model(self.features['data'], range(1, 4),
+                                         n_init=2, n_jobs=1, seed=1)
+        parallel = ss.cluster.select_model(self.features['data'], 
+                                           range(1, 4), n_init=2, n_jobs=2,
+                                           seed=1)
+        ok_((serial[0] == parallel[0]).all())
+        almost_equal(serial[1]['score'], parallel[1]['score'])
+    
+    def test_select_model_silhouette(self):
+        cl = ss.cluster.cluster('auto', self.features, range(2, 5), 
+                                'k_means', 'silhouette', n_jobs=2)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+        
+    def test_silhouette_score(self):
+        data = self.features['data']
+        dist = ss.cluster.metric_euclidean(data)
+        same = self.labels[:, np.newaxis] == self.labels
+        a = (dist*same).sum(1)/(same.sum(1)-1)
+        b = (dist*~same).sum(1)/(~same).sum(1)
+        score = ss.cluster.silhouette_score(data, self.labels, 
+                                            max_memory=1000)
+        ok_(np.abs(score - ((b-a)/np.maximum(a, b)).mean()) < 1e-10)
     
+    def test_cluster_model(self):
+        labels = self.labels + 1
+        model = ss.cluster.ClusterModel.from_labels(self.features, labels)
+        features = {'data': np.array([[0.5, 0.5], [2.5, 2.5], [10., 10.]]),
+                    'names': self.features['names']}
+        new_labels, score = model.predict(features, return_score=True)
+        ok_((new_labels == [1, 2, 0]).all())
+        ok_(score[2] > model.threshold)
+        
+    def test_cluster_model_save_load(self):
+        import tempfile, os
+        normalizer = ss.features.Normalizer().fit(self.features)
+        model = ss.cluster.ClusterModel.from_labels(self.features, 
+                                    self.labels + 1, covariance=False,
+                                    normalizer=normalizer,
+                                    feature_specs=[('fetP2P', (), {})])
+        fid, fname = tempfile.mkstemp(suffix='.npz')
+        os.close(fid)
+        try:
+            model.save(fname)
+            loaded = ss.cluster.ClusterModel.load(fname)
+        finally:
+            os.unlink(fname)
+        eq_(loaded.feature_specs, [('fetP2P', (), {})])
+        eq_(loaded.names, self.features['names'])
+        almost_equal(loaded.normalizer.upper, normalizer.upper)
+        ok_((loaded.predict(self.features) == self.labels + 1).all())
+        
+    def test_dbscan(self):
+        data = np.vstack((self.features['data'], [[10., 10.]]))
+        cl = ss.cluster.dbscan(data, eps=0.5, min_samples=3)
+        eq_(cl[-1], -1)
+        ok_(self._cmp_bin_partitions(cl[:-1], self.labels))
+        cl = ss.cluster.cluster('dbscan', self.features)
+        clustered = cl >= 0
+        eq_(len(np.unique(cl[clustered])), 2)
+        ok_(self._cmp_bin_partitions(cl[clustered], self.labels[clustered]))
+        
+    def test_dbscan_defaults(self):
+        for n_dims in [2, 3, 4]:
+            data = np.vstack((np.random.randn(1000, n_dims),
+                              np.random.randn(1000, n_dims) + 8))
+            cl = ss.cluster.dbscan(data, min_cluster_size=20)
+            eq_(len(np.unique(cl[cl >= 0])), 2)
+            
+    def test_dbscan_small_cluster(self):
+        data = np.vstack((np.random.randn(1000, 2),
+                          0.1*np.random.randn(8, 2) + 8))
+        cl = ss.cluster.dbscan(data, eps=0.5, min_samples=5)
+        small = cl[-8:]
+        ok_((small >= 0).all())
+        eq_(len(np.unique(small)), 1)
+        ok_(not np.isin(cl[:-8], small).any())
+        cl = ss.cluster.dbscan(data, eps=0.5, min_samples=5, 
+                               min_cluster_size=10)
+        ok_((cl[-8:] == -1).all())
+            
+    def test_cluster_warm(self):
+        labels = np.where(self.labels, 5, 2)
+        labels[0] = -1
+        cl = ss.cluster.cluster_warm('k_means', self.features, labels)
+        eq_(cl[0], -1)
+        ok_((cl[1:] == labels[1:]).all())
+        
+    def test_cluster_warm_gmm_diag(self):
+        labels = np.where(self.labels, 5, 2)
+        cl = ss.cluster.cluster_warm('gmm', self.features, labels, 
+                                     cov_type='diag')
+        ok_((cl == labels).all())
+        
+    def test_cluster_stats(self):
+        data = self.features['data']
+        stats = ss.cluster.ClusterStats.from_labels(data, self.labels)
+        stats.move(data[:10], self.labels[:10], 1)
+        stats.merge([1], 3)
+        summary = stats.summary()
+        ok_((summary['labels'] == [0, 3]).all())
+        ok_((summary['counts'] == [90, 110]).all())
+        almost_equal(summary['means'][0], data[10:100].mean(0))
+        almost_equal(summary['stds'][1], 
+                     np.vstack((data[:10], data[100:])).std(0))
+        
+    def test_remap_labels(self):
+        labels = np.array([0, 3, 5, 3, -1])
+        new_labels = ss.cluster.remap_labels(labels, {3: 1, 5: 3, 7: 2})
+        ok_((new_labels == [0, 1, 3, 1, -1]).all())
+        
+    def test_remap_labels_outliers(self):
+        labels = np.array([2**40, -2**40, 3, 7], dtype=np.int64)
+        new_labels = ss.cluster.remap_labels(labels, {-2**40: 1, 3: -1})
+        ok_((new_labels == [2**40, 1, -1, 7]).all())
+        eq_(new_labels.dtype, labels.dtype)
+        
+    def test_label_allocator(self):
+        allocator = ss.cluster.LabelAllocator.from_labels([0, 1, 3, 250])
+        eq_(allocator.allocate(3), [2, 4, 5])
+        allocator.release(3)
+        eq_(allocator.allocate(), [3])
+        
+    def test_k_means_n_init(self):
+        model = ss.cluster.KMeans(5, n_init=3, n_jobs=1, seed=1)
+        model.fit(self.features['data'])
+        eq_(len(model.scores), 3)
+        eq_(model.inertia, model.scores.min())
+        model2 = ss.cluster.KMeans(5, n_init=3, n_jobs=2, seed=1)
+        model2.fit(self.features['data'])
+        ok_((model2.scores == model.scores).all())
+        ok_((model2.labels == model.labels).all())
+        
+    def test_gmm_n_init(self):
+        cl = ss.cluster.cluster('gmm', self.features, self.K, n_init=2)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+        
+    def test_metric_euclidean(self):
+        data1 = np.random.randn(50, 3) + 10
+        data2 = np.random.randn(30, 3)
+        dist = ss.cluster.metric_euclidean(data1, data2, max_memory=1000)
+        dist_ref = np.sqrt(((data1[:, np.newaxis, :] - 
+                             data2[np.newaxis, :, :])**2).sum(2))
+        almost_equal(dist, dist_ref)
+        dist32 = ss.cluster.metric_euclidean(data1, data2, dtype=np.float32)
+        ok_(dist32.dtype == np.float32)
+        almost_equal(dist32, dist_ref, 4)
+        
+    def test_iter_metric_euclidean(self):
+        data = self.features['data']
+        dist = ss.cluster.metric_euclidean(data)
+        n_rows = 0
+        for start, stop, block in ss.cluster.iter_metric_euclidean(data, 
+                                                       max_memory=8*200*16):
+            ok_(block.shape == (16, 200) or stop == 200)
+            almost_equal(block, dist[start:stop])
+            n_rows += stop - start
+        eq_(n_rows, 200)
+        ok_((np.diag(dist)==0).all())
+        
     def test_random(self):
         cl = np.random.rand(len(self.labels))>0.5
         ok_(~self._cmp_bin_partitions(cl, self.labels))
         
+    def test_register_method(self):
+        ss.cluster.register_method('test_half', 
+                                   lambda data: data[:, 0] > 1)
+        cl = ss.cluster.cluster('test_half', self.features)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+        ok_('test_half' in ss.cluster.list_methods())
+        
+    def test_register_method_lazy(self):
+        ss.cluster.register_method('test_lazy', 
+                                   'spike_sort.core.cluster:k_means')
+        cl = ss.cluster.cluster('test_lazy', self.features, self.K)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+        
+    def test_callable_method(self):
+        cl = ss.cluster.cluster(ss.cluster.k_means, self.features, self.K)
+        ok_(self._cmp_bin_partitions(cl, self.labels))
+        
     @raises(NotImplementedError)
     def test_method_notimplemented(self):
         cl = ss.cluster.cluster("notimplemented", self.features)
         
         
         
+
+class TestEvaluate:
+    """test spike sorting quality metrics"""
+    
+    def setup(self):
+        np.random.seed(1234)
+        self.spike_waves = {'data': np.random.randn(20, 50, 2) + 1.}
+        self.noise_waves = {'data': np.random.randn(20, 80, 2)}
+        
+    def test_isolation_score_blocks(self):
+        sp_data = ss.cluster._waves2vectors(self.spike_waves)
+        ns_data = ss.cluster._waves2vectors(self.noise_waves)
+        all_data = np.vstack((sp_data, ns_data))
+        dist = np.sqrt(((sp_data[:, np.newaxis, :] - 
+                         all_data[np.newaxis, :, :])**2).sum(2))
+        iso_ref = ss.evaluate._iso_score_dist(dist, 10., len(sp_data))
+        iso = ss.evaluate.calc_isolation_score(self.spike_waves, 
+                                               self.noise_waves,
+                                               max_memory=1000)
+        ok_(np.abs(iso - iso_ref) < 1e-10)
+        
+    def _make_recording(self):
+        FS = 25E3
+        n_pts = int(FS*4)
+        signal = np.random.randn(1, n_pts)*5
+        spike_shape = np.exp(-np.arange(-10, 20)**2/8.)
+        times = np.random.permutation(np.arange(100, n_pts-100, 50))[:200]
+        amps = np.repeat([60, 30], 100)
+        for t, a in zip(times, amps):
+            signal[0, t-10:t+20] += a*spike_shape
+        sp = {'data': signal, 'FS': FS, 'n_contacts': 1}
+        spt = {'data': times*1000./FS}
+        return sp, spt, np.repeat([1, 2], 100)
+        
+    def test_isolation_scores(self):
+        sp, spt, labels = self._make_recording()
+        sp_win = (-0.4, 0.8)
+        scores = ss.evaluate.isolation_scores(sp, spt, labels, sp_win)
+        ok_((scores['label'] == [1, 2]).all())
+        ok_((scores['n_spikes'] == [100, 100]).all())
+        for cell, score in zip([1, 2], scores['isolation_score']):
+            cell_spt = {'data': spt['data'][labels == cell]}
+            iso = ss.evaluate.isolation_score(sp, cell_spt, sp_win)
+            ok_(np.abs(score - iso) < 0.05)
+        
+    def test_isolation_score_approx(self):
+        iso = ss.evaluate.calc_isolation_score(self.spike_waves, 
+                                               self.noise_waves)
+        iso_approx, error = ss.evaluate.calc_isolation_score_approx(
+                                self.spike_waves, self.noise_waves, 
+                                cutoff=7., n_components=None, 
+                                d0_samples=None, max_memory=1000)
+        ok_(np.abs(iso - iso_approx) <= error + 1e-10)
+        iso_approx, error = ss.evaluate.calc_isolation_score_approx(
+                                self.spike_waves, self.noise_waves, 
+                                cutoff=700., n_components=None, 
+                                d0_samples=None)
+        ok_(np.abs(iso - iso_approx) < 1e-10)
+        
+    def test_isolation_score_approx_bound(self):
+        rng = np.random.RandomState(0)
+        template = 8*np.sin(np.linspace(0, 3, 3))
+        spike_waves = {'data': template[:, np.newaxis, np.newaxis] + 
+                               rng.randn(3, 2000, 1)}
+        noise_waves = {'data': rng.randn(3, 2000, 1)}
+        iso = ss.evaluate.calc_isolation_score(spike_waves, noise_waves)
+        iso_approx, error = ss.evaluate.calc_isolation_score_approx(
+                                spike_waves, noise_waves, tol=0.01,
+                                d0_samples=None)
+        ok_(0 < error <= 0.01)
+        ok_(np.abs(iso - iso_approx) <= error + 1e-10)
+        
+    def test_isolation_score_approx_isolated(self):
+        rng = np.random.RandomState(0)
+        spike_waves = {'data': 20 + rng.randn(40, 500, 1)}
+        noise_waves = {'data': rng.randn(40, 500, 1)}
+        iso_approx, error = ss.evaluate.calc_isolation_score_approx(
+                                spike_waves, noise_waves)
+        ok_(iso_approx > 0.99)
+        ok_(error < 0.01)
+        
+    def test_sample_noise(self):
+        sp, spt, labels = self._make_recording()
+        sp_win = (-0.4, 0.8)
+        spt_noise = ss.evaluate.sample_noise(sp, spt, sp_win, 50, 
+                                             threshold=10., seed=5)
+        noise = spt_noise['data']
+        eq_(len(noise), 50)
+        ok_((np.diff(noise) > 0).all())
+        spt_left = ss.extract.remove_spikes(spt_noise, spt, sp_win)
+        eq_(len(spt_left['data']), 50)
+        idx = np.round(noise*sp['FS']/1000.).astype(int)
+        trace = sp['data'][0]
+        ok_((trace[idx] >= 10.).all())
+        ok_(((trace[idx] >= trace[idx-1]) & (trace[idx] >= trace[idx+1])).all())
+        spt_random = ss.evaluate.sample_noise(sp, spt, sp_win, 500,
+                                              method='random', seed=5)
+        eq_(len(spt_random['data']), 500)
+        
+    @raises(ValueError)
+    def test_sample_noise_unknown_method(self):
+        sp, spt, labels = self._make_recording()
+        ss.evaluate.sample_noise(sp, spt, (-0.4, 0.8), 10, method='peak')
+        
+    def test_quality_metrics(self):
+        n = 500
+        data = np.vstack([np.random.randn(n, 3), np.random.randn(n, 3)+4,
+                          np.random.randn(100, 3)*5])
+        labels = np.repeat([1, 2, 0], [n, n, 100])
+        duration = 100000.
+        spt = np.concatenate([np.random.rand(n)*duration, 
+                              np.random.rand(n)*duration/2, 
+                              np.random.rand(100)*duration])
+        amps = np.concatenate([np.random.randn(n)*10+100, 
+                               np.maximum(np.random.randn(n)*10+50, 50),
+                               np.random.rand(100)*50])
+        features = {'data': data, 'names': ['a', 'b', 'c']}
+        metrics = ss.evaluate.quality_metrics({'data': spt}, labels,
+                                              features, amps, 
+                                              t_range=(0, duration))
+        ok_((metrics['label'] == [1, 2]).all())
+        ok_((metrics['n_spikes'] == [n, n]).all())
+        for i, cell in enumerate([1, 2]):
+            isi = np.diff(np.sort(spt[labels == cell]))
+            eq_(metrics['n_isi_violations'][i], (isi < 1.5).sum())
+            cell_data = data[labels == cell]
+            mean, cov = cell_data.mean(0), np.cov(cell_data.T)
+            other = data[labels != cell] - mean
+            dist = (np.dot(other, np.linalg.inv(cov))*other).sum(1)
+            l_ratio = stats.chi2.sf(dist, 3).sum()/n
+            ok_(np.abs(metrics['l_ratio'][i] - l_ratio) < 1e-3*l_ratio)
+            iso_dist = np.sort(dist)[n-1]
+            ok_(np.abs(metrics['isolation_distance'][i] - iso_dist) < 
+                1e-3*iso_dist)
+        ok_(np.abs(metrics['presence_ratio'] - [1, 0.5]).max() < 0.05)
+        ok_(metrics['amplitude_cutoff'][0] < 0.05)
+        ok_(metrics['amplitude_cutoff'][1] > 0.4)
+        
+    def test_snr_spike_chunked(self):
+        sp_data = self.spike_waves['data']
+        avg_spike = sp_data.mean(1)
+        residuals = sp_data - avg_spike[:, np.newaxis]
+        snr = (avg_spike.max() - avg_spike.min())/(np.sqrt(residuals.var())*5.)
+        ok_(np.abs(ss.evaluate.snr_spike(self.spike_waves, chunk_size=7) - 
+                   snr) < 1e-10)
+        
+    def test_snr_scores(self):
+        labels = np.repeat([1, 2, 0], [20, 20, 10])
+        scores = ss.evaluate.snr_scores(self.spike_waves, labels, 
+                                        self.noise_waves, chunk_size=13)
+        ok_((scores['label'] == [1, 2]).all())
+        ok_((scores['n_spikes'] == [20, 20]).all())
+        for cell, score in zip([1, 2], scores):
+            cell_waves = {'data': self.spike_waves['data'][:, labels == cell]}
+            snr = ss.evaluate.snr_spike(cell_waves)
+            ok_(np.abs(score['snr_spike'] - snr) < 1e-10)
+            snr = ss.evaluate.snr_clust(cell_waves, self.noise_waves)
+            ok_(np.abs(score['snr_clust'] - snr) < 1e-10)